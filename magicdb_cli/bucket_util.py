@@ -16,61 +16,448 @@
 # GNU Affero General Public License for more details.
 #
 
+import hashlib
+import io
+import os
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from os import path
+from typing import List, Tuple
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
+from botocore.exceptions import ClientError
 
+from magicdb_cli.compress_util import CODEC_SUFFIXES, check_codec, compress_file
 
-def bucket_list_file_on_cur_dir(bucket: str, prefix: str, **kwargs):
-    config = None
-    if bucket.startswith("oss://"):
-        bucket = bucket[6:]  # strip "oss://"
-        config = Config(s3={"addressing_style": "virtual", "signature_version": 's3v4'})
+MB = 1024 * 1024
 
-    elif bucket.startswith("s3://"):
-        bucket = bucket[5:]
-    s3_resource = boto3.resource('s3', config=config,
-                                 **kwargs)
-    bucket = s3_resource.Bucket(bucket)
-    list = bucket.objects.filter(Prefix=prefix)
-    files = []
-    for o in list:
-        if o.key.endswith("/"):
-            continue
-        dirname = path.dirname(o.key)
-        prefix = path.dirname(prefix)
-        if dirname == prefix:
-            files.append(o.key)
-    return files
+# multipart settings of uploads
+MULTIPART_THRESHOLD = 64 * MB
+MULTIPART_CHUNKSIZE = 16 * MB
+MAX_CONCURRENCY = 8
 
+# files uploaded at the same time
+UPLOAD_WORKERS = 8
 
-def bucket_download_file(bucket: str, remote_path: str, dst_path: str, **kwargs):
-    config = None
+# extra attempts of a failed upload, waiting backoff, 2 * backoff, ... seconds
+# between them, like TASK_RETRIES of magicdbLoad
+UPLOAD_RETRIES = 2
+UPLOAD_BACKOFF = 1.0
+
+# http connections kept by every cached client
+MAX_POOL_CONNECTIONS = 32
+
+# prefixes listed at the same time by a recursive listing
+LIST_WORKERS = 8
+
+# least bytes fetched by every ranged get of a direct read
+READ_AHEAD = 8 * MB
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _reset_clients():
+    # clients hold sockets and locks that must not be shared with a forked child
+    global _clients_lock
+    _clients.clear()
+    _clients_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_clients)
+
+
+def get_bucket_client(bucket: str, **kwargs):
+    """get the cached s3 client of the bucket, clients are thread safe and are
+    shared by every call with the same scheme, endpoint, region, credentials and
+    addressing style
+
+    Args:
+        bucket (str): bucket name example: oss://bucket1 | s3://bucket1
+        max_pool_connections (int, optional): http connections of the client. Defaults to MAX_POOL_CONNECTIONS.
+        kwargs: boto3 client arguments, endpoint_url, region_name, aws_access_key_id, ...
+
+    Returns:
+        Tuple[client, str]: the s3 client and the bucket name without scheme
+    """
+    max_pool_connections = kwargs.pop("max_pool_connections", MAX_POOL_CONNECTIONS)
+    scheme, addressing_style = "", None
     if bucket.startswith("oss://"):
-        bucket = bucket[6:]  # strip "oss://"
-        config = Config(s3={"addressing_style": "virtual", "signature_version": 's3v4'})
+        scheme, bucket = "oss", bucket[6:]  # strip "oss://"
+        addressing_style = "virtual"
     elif bucket.startswith("s3://"):
-        bucket = bucket[5:]
-    s3c = boto3.client('s3', config=config, **kwargs)
+        scheme, bucket = "s3", bucket[5:]
+
+    key = (scheme, addressing_style, max_pool_connections, tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            s3 = None
+            if addressing_style is not None:
+                s3 = {"addressing_style": addressing_style, "signature_version": 's3v4'}
+            config = Config(s3=s3, max_pool_connections=max_pool_connections)
+            # the default boto3 session is not thread safe
+            client = boto3.session.Session().client('s3', config=config, **kwargs)
+            _clients[key] = client
+    return client, bucket
+
+
+def transfer_config(multipart_threshold: int = MULTIPART_THRESHOLD,
+                    multipart_chunksize: int = MULTIPART_CHUNKSIZE,
+                    max_concurrency: int = MAX_CONCURRENCY,
+                    ) -> TransferConfig:
+    return TransferConfig(multipart_threshold=multipart_threshold,
+                          multipart_chunksize=multipart_chunksize,
+                          max_concurrency=max_concurrency,
+                          use_threads=max_concurrency > 1)
+
+
+def _list_prefix(s3c, bucket: str, prefix: str) -> Tuple[List[dict], List[str]]:
+    paginator = s3c.get_paginator("list_objects_v2")
+    objects, prefixes = [], []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        for o in page.get("Contents", []):
+            if o["Key"].endswith("/"):
+                continue
+            objects.append({"key": o["Key"], "size": o["Size"], "etag": o["ETag"].strip('"')})
+        prefixes.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+    return objects, prefixes
+
+
+def bucket_list_objects(bucket: str, prefix: str,
+                        recursive: bool = False,
+                        workers: int = LIST_WORKERS,
+                        **kwargs) -> List[dict]:
+    """list the objects of a prefix one directory level at a time, the keys below
+    the sub directories are never listed unless recursive
+
+    Args:
+        bucket (str): bucket name example: oss://bucket1 | s3://bucket1
+        prefix (str): key prefix, ends with "/" to list a directory
+        recursive (bool, optional): list the sub directories too. Defaults to False.
+        workers (int, optional): sub directories listed at the same time. Defaults to LIST_WORKERS.
+
+    Returns:
+        List[dict]: key, size and etag of every object
+    """
+    s3c, bucket = get_bucket_client(bucket, **kwargs)
+    objects, prefixes = _list_prefix(s3c, bucket, prefix)
+    if not recursive:
+        return objects
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while len(prefixes) > 0:
+            level = []
+            for sub_objects, sub_prefixes in pool.map(lambda p: _list_prefix(s3c, bucket, p), prefixes):
+                objects.extend(sub_objects)
+                level.extend(sub_prefixes)
+            prefixes = level
+    return objects
+
+
+def bucket_list_file_on_cur_dir(bucket: str, prefix: str, **kwargs):
+    return [o["key"] for o in bucket_list_objects(bucket, prefix, **kwargs)]
+
+
+def bucket_download_file(bucket: str, remote_path: str, dst_path: str, **kwargs):
+    s3c, bucket = get_bucket_client(bucket, **kwargs)
 
     with open(dst_path, 'wb') as f:
         s3c.download_fileobj(bucket, remote_path, f)
 
 
-def bucket_upload_file(local_path: str, bucket: str, remote_path: str, **kwargs):
+def bucket_object_size(bucket: str, remote_path: str, **kwargs) -> int:
+    """size of a remote file, None if it does not exist"""
+    s3c, bucket = get_bucket_client(bucket, **kwargs)
+    try:
+        resp = s3c.head_object(Bucket=bucket, Key=remote_path)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return resp["ContentLength"]
+
+
+def file_sha256(local_path: str, chunk_size: int = MB) -> str:
+    digest = hashlib.sha256()
+    with open(local_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def bucket_read_tail(bucket: str, remote_path: str, length: int, **kwargs) -> bytes:
+    """read the last bytes of a remote file with a ranged get
+
+    Args:
+        bucket (str): bucket name example: oss://bucket1 | s3://bucket1
+        remote_path (str): remote file path
+        length (int): bytes to read, the whole file if it is shorter
+
+    Returns:
+        bytes: the tail of the file
+    """
+    s3c, bucket = get_bucket_client(bucket, **kwargs)
+    resp = s3c.get_object(Bucket=bucket, Key=remote_path, Range=f"bytes=-{length}")
+    return resp["Body"].read()
+
+
+class BucketFile(io.RawIOBase):
+    """read only, seekable remote file, every read is served by a ranged get of
+    at least read_ahead bytes and the fetched window is kept for the small reads
+    that follow it"""
+
+    def __init__(self, bucket: str, remote_path: str,
+                 read_ahead: int = READ_AHEAD,
+                 size: int = None,
+                 **kwargs) -> None:
+        """
+        Args:
+            bucket (str): bucket name example: oss://bucket1 | s3://bucket1
+            remote_path (str): remote file path
+            read_ahead (int, optional): least bytes of every ranged get. Defaults to READ_AHEAD.
+            size (int, optional): file size, asked with a head request if None. Defaults to None.
+        """
+        super().__init__()
+        self.s3c, self.bucket = get_bucket_client(bucket, **kwargs)
+        self.remote_path = remote_path
+        self.read_ahead = read_ahead
+        if size is None:
+            size = self.s3c.head_object(Bucket=self.bucket, Key=remote_path)["ContentLength"]
+        self.size = size
+        self.pos = 0
+        self.window_start, self.window = 0, b""
+        # bytes and seconds of the ranged gets
+        self.stats = {"bytes": 0, "seconds": 0.0}
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"whence: {whence} not support")
+        if pos < 0:
+            raise ValueError(f"negative seek position: {pos}")
+        self.pos = pos
+        return pos
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        begin = time.time()
+        resp = self.s3c.get_object(Bucket=self.bucket, Key=self.remote_path,
+                                   Range=f"bytes={start}-{end - 1}")
+        data = resp["Body"].read()
+        self.stats["bytes"] += len(data)
+        self.stats["seconds"] += time.time() - begin
+        return data
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.size - self.pos
+        end = min(self.pos + size, self.size)
+        if end <= self.pos:
+            return b""
+        window_end = self.window_start + len(self.window)
+        if self.window_start <= self.pos and end <= window_end:
+            data = self.window[self.pos - self.window_start: end - self.window_start]
+        elif end - self.pos >= self.read_ahead:
+            # large reads, like pre buffered column chunks, skip the window
+            data = self._fetch(self.pos, end)
+        else:
+            self.window_start = self.pos
+            self.window = self._fetch(self.pos, min(self.pos + self.read_ahead, self.size))
+            data = self.window[: end - self.pos]
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+
+def bucket_upload_file(local_path: str, bucket: str, remote_path: str,
+                       transfer: TransferConfig = None,
+                       retries: int = UPLOAD_RETRIES,
+                       backoff: float = UPLOAD_BACKOFF,
+                       **kwargs):
     print("upload file ", local_path, " to ", path.join(bucket, remote_path))
-    config = None
-    if bucket.startswith("oss://"):
-        bucket = bucket[6:]  # strip "oss://"
-        config = Config(s3={"addressing_style": "virtual", "signature_version": 's3v4'})
-    elif bucket.startswith("s3://"):
-        bucket = bucket[5:]
-    s3_resource = boto3.resource('s3', config=config, **kwargs)
-    s3_resource.meta.client.upload_file(local_path, bucket, remote_path)
+    s3c, bucket = get_bucket_client(bucket, **kwargs)
+    # one attempt at least, so a file is never silently left out
+    for attempt in range(max(retries, 0) + 1):
+        try:
+            s3c.upload_file(local_path, bucket, remote_path, Config=transfer or transfer_config())
+            return
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            wait = backoff * (2 ** attempt)
+            print(f"upload file {local_path} failed: {e}, retry in {wait:.1f}s")
+            time.sleep(wait)
+
+
+class BucketUploader:
+    """upload files in background threads as they are submitted, every file is
+    hashed with sha256 and optionally compressed on the way"""
+
+    def __init__(self, bucket: str,
+                 workers: int = UPLOAD_WORKERS,
+                 transfer: TransferConfig = None,
+                 retries: int = UPLOAD_RETRIES,
+                 remove: bool = False,
+                 content_dir: str = None,
+                 codec: str = None,
+                 level: int = None,
+                 **kwargs) -> None:
+        """
+        Args:
+            bucket (str): bucket name example: oss://bucket1 | s3://bucket1
+            workers (int, optional): files uploaded at the same time. Defaults to UPLOAD_WORKERS.
+            transfer (TransferConfig, optional): multipart settings. Defaults to transfer_config().
+            retries (int, optional): extra attempts of a failed file. Defaults to UPLOAD_RETRIES.
+            remove (bool, optional): delete the local file once uploaded. Defaults to False.
+            content_dir (str, optional): upload every file to content_dir/<sha256><suffix>
+                instead of its remote path, and skip the files already there. Defaults to None.
+            codec (str, optional): zstd | lz4, compress every file before its upload and add
+                the suffix of the codec to its remote path. Defaults to None.
+            level (int, optional): compression level of the codec. Defaults to None.
+
+        Raises:
+            ValueError: unknown codec
+            ImportError: the package of the codec is not installed
+        """
+        if codec is not None:
+            check_codec(codec)
+        self.bucket = bucket
+        self.transfer = transfer
+        self.retries = retries
+        self.remove = remove
+        self.content_dir = content_dir
+        self.codec = codec
+        self.level = level
+        self.kwargs = kwargs
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.futures = []
+        self.lock = threading.Lock()
+        self.start = None
+        self.done, self.bytes, self.skipped = 0, 0, 0
+
+    def _upload(self, local_path: str, remote_path: str) -> dict:
+        size = path.getsize(local_path)
+        # the hash is of the original file, whatever the codec
+        sha256 = file_sha256(local_path)
+        suffix = CODEC_SUFFIXES[self.codec] if self.codec is not None else ""
+        remote_size = None
+        if self.content_dir is not None:
+            remote_path = path.join(self.content_dir, sha256 + path.splitext(local_path)[1])
+            remote_size = bucket_object_size(self.bucket, remote_path + suffix, **self.kwargs)
+        skipped = remote_size is not None
+        remote_path += suffix
+        upload_path = local_path
+        if self.codec is not None and not skipped:
+            upload_path = compress_file(local_path, self.codec, self.level)
+        upload_size = remote_size if skipped else path.getsize(upload_path)
+        if not skipped:
+            bucket_upload_file(upload_path, self.bucket, remote_path,
+                               self.transfer, self.retries, **self.kwargs)
+        if upload_path != local_path:
+            os.remove(upload_path)
+        if self.remove:
+            os.remove(local_path)
+        with self.lock:
+            self.done += 1
+            if skipped:
+                self.skipped += 1
+            else:
+                self.bytes += upload_size
+            cost = time.time() - self.start
+            print(f"uploaded {self.done}/{len(self.futures)} files, skipped {self.skipped}, "
+                  f"{self.bytes / MB:.1f} MiB, {self.bytes / MB / max(cost, 1e-6):.1f} MiB/s")
+        ret = {"path": remote_path, "sha256": sha256, "bytes": size, "skipped": skipped}
+        if self.codec is not None:
+            ret["codec"] = self.codec
+            ret["compressed_bytes"] = upload_size
+        return ret
+
+    def submit(self, local_path: str, remote_path: str) -> Future:
+        """upload a file in the background
+
+        Args:
+            local_path (str): local file path
+            remote_path (str): remote file path, unused with content_dir
+
+        Returns:
+            Future: path, sha256, bytes and skipped of the uploaded file, and codec and
+                compressed_bytes when compressed
+        """
+        with self.lock:
+            if self.start is None:
+                self.start = time.time()
+            future = self.pool.submit(self._upload, local_path, remote_path)
+            self.futures.append(future)
+        return future
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+        self.pool.shutdown(wait=True)
+
+    def wait(self) -> dict:
+        """wait for all the uploads
+
+        Raises:
+            Exception: the first failed upload
+
+        Returns:
+            dict: files, skipped files, bytes and seconds of the upload, timed from the first submit
+        """
+        try:
+            for future in self.futures:
+                future.result()
+        except Exception:
+            self.cancel()
+            raise
+        self.pool.shutdown(wait=True)
+        seconds = time.time() - self.start if self.start is not None else 0.0
+        return {"files": self.done, "skipped": self.skipped, "bytes": self.bytes, "seconds": seconds}
+
+
+def bucket_upload_files(files: List[Tuple[str, str]], bucket: str,
+                        workers: int = UPLOAD_WORKERS,
+                        transfer: TransferConfig = None,
+                        retries: int = UPLOAD_RETRIES,
+                        **kwargs) -> dict:
+    """upload files with a bounded thread pool
+
+    Args:
+        files (List[Tuple[str, str]]): (local path, remote path) to upload
+        bucket (str): bucket name example: oss://bucket1 | s3://bucket1
+        workers (int, optional): files uploaded at the same time. Defaults to UPLOAD_WORKERS.
+        transfer (TransferConfig, optional): multipart settings. Defaults to transfer_config().
+        retries (int, optional): extra attempts of a failed file. Defaults to UPLOAD_RETRIES.
 
-    pass
+    Returns:
+        dict: files, bytes and seconds of the upload
+    """
+    uploader = BucketUploader(bucket, workers, transfer, retries, **kwargs)
+    for local_path, remote_path in files:
+        uploader.submit(local_path, remote_path)
+    return uploader.wait()
 
 
 if __name__ == "__main__":
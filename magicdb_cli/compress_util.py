@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+#
+# `magicdb-cli` - 'client for magicdb'
+# Copyright (C) 2019 - present timepi <timepi123@gmail.com>
+# `magicdb-cli` is provided under: GNU Affero General Public License
+# (AGPL3.0) https:#www.gnu.org/licenses/agpl-3.0.html unless stated otherwise.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+
+# optional compression of the partition files, zstd needs `pip install zstandard`
+# and lz4 needs `pip install lz4`
+
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# suffix of the compressed files of every codec
+CODEC_SUFFIXES = {"zstd": ".zst", "lz4": ".lz4"}
+
+# compression level used when none is given
+DEFAULT_LEVELS = {"zstd": 3, "lz4": 0}
+
+# threads of one zstd compression, 0 compresses in the calling thread
+ZSTD_THREADS = 2
+
+MB = 1024 * 1024
+
+
+def check_codec(codec: str):
+    """check that a codec is known and its package is installed
+
+    Args:
+        codec (str): zstd | lz4
+
+    Raises:
+        ValueError: unknown codec
+        ImportError: the package of the codec is not installed
+    """
+    if codec not in CODEC_SUFFIXES:
+        raise ValueError(f"codec: {codec} not support")
+    if codec == "zstd" and zstandard is None:
+        raise ImportError("codec zstd needs the zstandard package")
+    if codec == "lz4" and lz4_frame is None:
+        raise ImportError("codec lz4 needs the lz4 package")
+
+
+def compress_file(src_path: str, codec: str, level: int = None, threads: int = ZSTD_THREADS) -> str:
+    """compress a file next to it
+
+    Args:
+        src_path (str): file to compress
+        codec (str): zstd | lz4
+        level (int, optional): compression level. Defaults to DEFAULT_LEVELS[codec].
+        threads (int, optional): threads of a zstd compression. Defaults to ZSTD_THREADS.
+
+    Raises:
+        ValueError: unknown codec
+        ImportError: the package of the codec is not installed
+
+    Returns:
+        str: path of the compressed file, src_path plus the suffix of the codec
+    """
+    check_codec(codec)
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    dst_path = src_path + CODEC_SUFFIXES[codec]
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        if codec == "zstd":
+            cctx = zstandard.ZstdCompressor(level=level, threads=threads, write_content_size=True)
+            cctx.copy_stream(src, dst, size=os.path.getsize(src_path), write_size=MB)
+        else:
+            with lz4_frame.LZ4FrameFile(dst, mode="wb", compression_level=level) as writer:
+                for chunk in iter(lambda: src.read(MB), b""):
+                    writer.write(chunk)
+    return dst_path
+
+
+def decompress_file(src_path: str, dst_path: str, codec: str):
+    """decompress a file written by compress_file
+
+    Args:
+        src_path (str): compressed file
+        dst_path (str): where to put the original file
+        codec (str): zstd | lz4
+    """
+    check_codec(codec)
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        if codec == "zstd":
+            zstandard.ZstdDecompressor().copy_stream(src, dst, write_size=MB)
+        else:
+            with lz4_frame.LZ4FrameFile(src, mode="rb") as reader:
+                for chunk in iter(lambda: reader.read(MB), b""):
+                    dst.write(chunk)
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+#
+# `magicdb-cli` - 'client for magicdb'
+# Copyright (C) 2019 - present timepi <timepi123@gmail.com>
+# `magicdb-cli` is provided under: GNU Affero General Public License
+# (AGPL3.0) https:#www.gnu.org/licenses/agpl-3.0.html unless stated otherwise.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+
+# batched murmur3 hashing of key columns, partition id of a key is
+# mmh3.hash64(str(key), signed=False)[0] % partitions
+
+from typing import Union
+
+import mmh3
+import numpy as np
+import pyarrow
+import pyarrow.compute as pc
+
+KeyArray = Union[pyarrow.Array, pyarrow.ChunkedArray]
+
+# rows hashed together, bounds the padded key matrix
+HASH_CHUNK_ROWS = 262144
+
+_C1 = np.uint64(0x87C37B91114253D5)
+_C2 = np.uint64(0x4CF5AD432745937F)
+_F1 = np.uint64(0xFF51AFD7ED558CCD)
+_F2 = np.uint64(0xC4CEB9FE1A85EC53)
+_N1 = np.uint64(0x52DCE729)
+_N2 = np.uint64(0x38495AB5)
+_FIVE = np.uint64(5)
+
+
+def _rotl(x: np.ndarray, r: int) -> np.ndarray:
+    return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+
+def _fmix(k: np.ndarray) -> np.ndarray:
+    k = k ^ (k >> np.uint64(33))
+    k = k * _F1
+    k = k ^ (k >> np.uint64(33))
+    k = k * _F2
+    return k ^ (k >> np.uint64(33))
+
+
+def _mix_k1(k1: np.ndarray) -> np.ndarray:
+    return _rotl(k1 * _C1, 31) * _C2
+
+
+def _mix_k2(k2: np.ndarray) -> np.ndarray:
+    return _rotl(k2 * _C2, 33) * _C1
+
+
+def _keys_to_strings(keys: pyarrow.Array) -> pyarrow.Array:
+    """cast the key array to utf8, integers use their decimal form like str()
+
+    Args:
+        keys (pyarrow.Array): key array
+
+    Raises:
+        TypeError: key type not supported
+
+    Returns:
+        pyarrow.Array: string array
+    """
+    if pyarrow.types.is_integer(keys.type):
+        return pc.cast(keys, pyarrow.string())
+    if pyarrow.types.is_string(keys.type) or pyarrow.types.is_large_string(keys.type):
+        return keys
+    raise TypeError(f"{keys.type} not support for hash key")
+
+
+def _murmur3_chunk(keys: pyarrow.Array) -> np.ndarray:
+    """murmur3 x64 128 of string keys, all keys processed in lockstep
+
+    Args:
+        keys (pyarrow.Array): utf8 keys without nulls
+
+    Returns:
+        np.ndarray: low 64 bits of the hashes, uint64
+    """
+    n = len(keys)
+    buffers = keys.buffers()
+    offset_type = np.int64 if pyarrow.types.is_large_string(keys.type) else np.int32
+    offsets = np.frombuffer(buffers[1], dtype=offset_type)[keys.offset: keys.offset + n + 1]
+    offsets = offsets.astype(np.int64)
+    data = np.frombuffer(buffers[2], dtype=np.uint8) if buffers[2] is not None \
+        else np.zeros(0, dtype=np.uint8)
+    lengths = np.diff(offsets)
+
+    # pad every key with zeros to a whole number of 16 bytes blocks plus
+    # one tail block, zero bytes mix to zero so the tail needs no masking
+    nblocks = lengths // 16
+    max_blocks = int(nblocks.max()) if n > 0 else 0
+    width = (max_blocks + 1) * 16
+    padded = np.zeros((n, width), dtype=np.uint8)
+    min_length = int(lengths.min()) if n > 0 else 0
+    max_length = int(lengths.max()) if n > 0 else 0
+    if min_length == max_length:
+        padded[:, :max_length] = data[offsets[0]: offsets[-1]].reshape(n, max_length)
+    elif max_length * n <= 2 * (offsets[-1] - offsets[0]):
+        # similar lengths, copy byte columns
+        starts = offsets[:-1]
+        last = max(int(offsets[-1]) - 1, 0)
+        for j in range(max_length):
+            column = data[np.minimum(starts + j, last)]
+            padded[:, j] = np.where(lengths > j, column, 0)
+    else:
+        # skewed lengths, scatter every byte to its padded position
+        starts = np.arange(n, dtype=np.int64) * width - (offsets[:-1] - offsets[0])
+        flat = np.repeat(starts, lengths) + np.arange(offsets[-1] - offsets[0])
+        padded.ravel()[flat] = data[offsets[0]: offsets[-1]]
+    words = padded.view("<u8").astype(np.uint64, copy=False)
+
+    h1 = np.zeros(n, dtype=np.uint64)
+    h2 = np.zeros(n, dtype=np.uint64)
+    for b in range(max_blocks):
+        active = nblocks > b
+        k1 = words[:, 2 * b]
+        k2 = words[:, 2 * b + 1]
+        t1 = h1 ^ _mix_k1(k1)
+        t1 = (_rotl(t1, 27) + h2) * _FIVE + _N1
+        t2 = h2 ^ _mix_k2(k2)
+        t2 = (_rotl(t2, 31) + t1) * _FIVE + _N2
+        h1 = np.where(active, t1, h1)
+        h2 = np.where(active, t2, h2)
+
+    index = np.arange(n)
+    h2 ^= _mix_k2(words[index, 2 * nblocks + 1])
+    h1 ^= _mix_k1(words[index, 2 * nblocks])
+
+    length = lengths.astype(np.uint64)
+    h1 ^= length
+    h2 ^= length
+    h1 += h2
+    h2 += h1
+    h1 = _fmix(h1)
+    h2 = _fmix(h2)
+    return h1 + h2
+
+
+def _murmur3_grouped(keys: pyarrow.Array) -> np.ndarray:
+    """murmur3 of string keys, keys are padded with the keys of the same block
+    number only, so a few long keys do not widen the padded matrix of the others
+
+    Args:
+        keys (pyarrow.Array): utf8 keys without nulls
+
+    Returns:
+        np.ndarray: low 64 bits of the hashes, uint64
+    """
+    n = len(keys)
+    if n == 0:
+        return np.zeros(0, dtype=np.uint64)
+    lengths = pc.binary_length(keys).to_numpy(zero_copy_only=False).astype(np.int64)
+    # padding at most doubles the key bytes, hash them together
+    width = (int(lengths.max()) // 16 + 1) * 16
+    if n * width <= 2 * (int(lengths.sum()) + 16 * n):
+        return _murmur3_chunk(keys)
+    nblocks = lengths // 16
+    hashes = np.empty(n, dtype=np.uint64)
+    for b in np.unique(nblocks):
+        rows = np.flatnonzero(nblocks == b)
+        hashes[rows] = _murmur3_chunk(keys.take(pyarrow.array(rows)))
+    return hashes
+
+
+def hash_keys(keys: KeyArray) -> np.ndarray:
+    """hash the whole key column with murmur3, vectorized
+
+    Args:
+        keys (KeyArray): string or integer keys
+
+    Returns:
+        np.ndarray: mmh3.hash64(str(key), signed=False)[0] of every key, uint64
+    """
+    if isinstance(keys, pyarrow.ChunkedArray):
+        if keys.num_chunks == 0:
+            return np.zeros(0, dtype=np.uint64)
+        return np.concatenate([hash_keys(chunk) for chunk in keys.chunks])
+    if keys.null_count > 0:
+        raise ValueError("null value found in hash key")
+    keys = _keys_to_strings(keys)
+    results = []
+    for start in range(0, len(keys), HASH_CHUNK_ROWS):
+        results.append(_murmur3_grouped(keys.slice(start, HASH_CHUNK_ROWS)))
+    if len(results) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return np.concatenate(results)
+
+
+def hash_keys_per_row(keys: KeyArray) -> np.ndarray:
+    """hash the key column row by row with mmh3, fallback of hash_keys
+
+    Args:
+        keys (KeyArray): string or integer keys
+
+    Returns:
+        np.ndarray: mmh3.hash64(str(key), signed=False)[0] of every key, uint64
+    """
+    return np.fromiter(
+        (mmh3.hash64(str(k), signed=False)[0] for k in keys.to_pylist()),
+        dtype=np.uint64,
+        count=len(keys),
+    )
+
+
+def partition_ids(keys: KeyArray, partitions: int, vectorized: bool = True) -> np.ndarray:
+    """get the partition id of every key
+
+    Args:
+        keys (KeyArray): string or integer keys
+        partitions (int): partition number
+        vectorized (bool, optional): use the batched engine. Defaults to True.
+
+    Returns:
+        np.ndarray: partition ids, int64
+    """
+    hashes = hash_keys(keys) if vectorized else hash_keys_per_row(keys)
+    return (hashes % np.uint64(partitions)).astype(np.int64)
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+#
+# `magicdb-cli` - 'client for magicdb'
+# Copyright (C) 2019 - present timepi <timepi123@gmail.com>
+# `magicdb-cli` is provided under: GNU Affero General Public License
+# (AGPL3.0) https:#www.gnu.org/licenses/agpl-3.0.html unless stated otherwise.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+
+# benchmarks and parity checks of the loader, example:
+#   python -m magicdb_cli.magicdbBench hash --rows 1000000
+
+import argparse
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import boto3
+import numpy as np
+import pyarrow
+import pyarrow.compute as pc
+from botocore.config import Config
+
+from magicdb_cli.bucket_util import get_bucket_client
+from magicdb_cli.hash_util import hash_keys, hash_keys_per_row, partition_ids
+from magicdb_cli.magicdbLoad import (
+    TABLE_LAYOUTS,
+    PartitionWriter,
+    arrow_rows,
+    generate_sqlite_ddl,
+    get_sqlite_insert_sql,
+    write_partitioned_rows,
+)
+
+
+def timeit(func, *args, **kwargs):
+    start = time.time()
+    ret = func(*args, **kwargs)
+    return ret, time.time() - start
+
+
+def synthetic_keys(rows: int, seed: int = 0) -> dict:
+    """generate integer and string key columns
+
+    Args:
+        rows (int): row number
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dict: name -> key column
+    """
+    rng = np.random.default_rng(seed)
+    ints = pyarrow.array(rng.integers(-(2 ** 62), 2 ** 62, size=rows))
+    strs = pc.binary_join_element_wise(
+        "user_", pc.cast(pyarrow.array(rng.integers(0, 2 ** 40, size=rows)), pyarrow.string()), ""
+    )
+    return {"int64": ints, "string": strs}
+
+
+def edge_case_keys(rows: int, seed: int = 0) -> dict:
+    """generate string key columns with the layouts the batched hash must handle
+
+    Args:
+        rows (int): row number
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        dict: name -> key column
+    """
+    rng = np.random.default_rng(seed)
+    alphabet = list("abcXYZ0129_-") + ["é", "ß", "用", "户", "😀"]
+    lengths = rng.integers(0, 48, size=rows)
+    chars = rng.integers(0, len(alphabet), size=int(lengths.sum()))
+    keys, start = [], 0
+    for length in lengths:
+        keys.append("".join(alphabet[c] for c in chars[start: start + length]))
+        start += length
+    mixed = pyarrow.array(keys, pyarrow.string())
+    half = rows // 2
+    return {
+        "mixed": mixed,
+        "empty": pyarrow.array([""] * rows, pyarrow.string()),
+        "sliced": mixed.slice(3, max(rows - 10, 0)),
+        "large": pc.cast(mixed, pyarrow.large_string()),
+        "chunked": pyarrow.chunked_array([mixed.slice(0, half), mixed.slice(half)]),
+        "outlier": pyarrow.array(keys[:-1] + ["x" * 8192], pyarrow.string()),
+    }
+
+
+def synthetic_table(rows: int, seed: int = 0, key_type: str = "int64") -> pyarrow.Table:
+    """generate a feature table
+
+    Args:
+        rows (int): row number
+        seed (int, optional): random seed. Defaults to 0.
+        key_type (str, optional): int64 | string, type of the primary key. Defaults to "int64".
+
+    Returns:
+        pyarrow.Table: table with columns pk, f_int, f_real, f_text
+    """
+    rng = np.random.default_rng(seed)
+    pk = pyarrow.array(np.arange(rows, dtype=np.int64))
+    if key_type == "string":
+        pk = pc.binary_join_element_wise("user_", pc.cast(pk, pyarrow.string()), "")
+    return pyarrow.table({
+        "pk": pk,
+        "f_int": pyarrow.array(rng.integers(0, 1000, size=rows)),
+        "f_real": pyarrow.array(rng.random(rows)),
+        "f_text": pc.cast(pyarrow.array(rng.integers(0, 100000, size=rows)), pyarrow.string()),
+    })
+
+
+def sqlite_digest(db_path: str, table_name: str) -> str:
+    conn = sqlite3.connect(db_path)
+    digest = hashlib.md5()
+    for row in conn.execute(f"select * from {table_name} order by rowid"):
+        digest.update(repr(row).encode())
+    conn.close()
+    return digest.hexdigest()
+
+
+def bench_hash(args):
+    """check the batched hash engine against mmh3 and report the throughput"""
+    keys = synthetic_keys(args.rows)
+    keys.update(edge_case_keys(min(args.rows, args.edge_rows)))
+    for name, keys in keys.items():
+        batched, batched_cost = timeit(hash_keys, keys)
+        per_row, per_row_cost = timeit(hash_keys_per_row, keys)
+        if not np.array_equal(batched, per_row):
+            raise AssertionError(f"{name} keys: batched hash differs from mmh3")
+        print(f"{name:>8} keys: batched {len(keys) / batched_cost:,.0f} rows/s, "
+              f"per row {len(keys) / per_row_cost:,.0f} rows/s, parity ok")
+
+
+def bench_spark_hash(args):
+    """check the partition ids of the spark loader against magicdbLoad and report the throughput"""
+    # the spark loader imports pyspark
+    from magicdb_cli import magicdbLoadSpark
+
+    keys = synthetic_keys(args.rows)
+    keys["unicode"] = pc.binary_join_element_wise("用户_", pc.cast(keys["int64"], pyarrow.string()), "")
+    for name, column in keys.items():
+        expected = partition_ids(column, args.partitions)
+        series = column.to_pandas()
+        values = series.tolist()
+        paths = {
+            "vectorized": lambda: magicdbLoadSpark.hash_partition_ids(series, args.partitions).to_numpy(),
+            "key_hash": lambda: np.array([magicdbLoadSpark.key_hash(k) % args.partitions for k in values]),
+            "pure python": lambda: np.array([
+                magicdbLoadSpark.hash64(str(k), seed=0, signed=False)[0] % args.partitions
+                for k in values[:args.python_rows]]),
+        }
+        report = []
+        for label, func in paths.items():
+            ids, cost = timeit(func)
+            if not np.array_equal(ids, expected[:len(ids)]):
+                raise AssertionError(f"{name} keys: spark {label} partition ids differ from magicdbLoad")
+            report.append(f"{label} {len(ids) / cost:,.0f} rows/s")
+        print(f"{name:>8} keys: {', '.join(report)}, parity ok")
+
+
+def bench_insert(args):
+    """compare the arrow and pandas sqlite insert paths on the same table"""
+    table = synthetic_table(args.rows)
+    work_dir = tempfile.mkdtemp(prefix="magicdb-bench-")
+    digests = {}
+    try:
+        for mode in ("arrow", "pandas"):
+            db_path = os.path.join(work_dir, f"{mode}.db")
+            conn = sqlite3.connect(db_path)
+            cur = conn.cursor()
+            dmls = []
+            for i in range(args.partitions):
+                cur.execute(generate_sqlite_ddl(table.schema, "pk", f"t_{i}"))
+                dmls.append(get_sqlite_insert_sql(table.schema, f"t_{i}"))
+            cur.execute("""PRAGMA synchronous = OFF;""")
+            cur.execute("""PRAGMA journal_mode = OFF;""")
+            _, cost = timeit(write_partitioned_rows, cur, dmls, table, "pk", args.partitions, mode)
+            conn.commit()
+            conn.close()
+            digests[mode] = [sqlite_digest(db_path, f"t_{i}") for i in range(args.partitions)]
+            print(f"{mode:>8}: {cost:.2f}s, {args.rows / cost:,.0f} rows/s")
+        if digests["arrow"] != digests["pandas"]:
+            raise AssertionError("arrow and pandas paths wrote different sqlite data")
+        print("sqlite output identical")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def bench_lookup(args):
+    """compare point get latency and file size of the table layouts"""
+    table = synthetic_table(args.rows, key_type=args.key_type)
+    keys = table.column("pk").take(
+        pyarrow.array(np.random.default_rng(1).integers(0, args.rows, size=args.lookups))).to_pylist()
+    work_dir = tempfile.mkdtemp(prefix="magicdb-bench-")
+    try:
+        for layout in TABLE_LAYOUTS:
+            db_path = os.path.join(work_dir, f"{layout}.db")
+            writer = PartitionWriter(db_path, "t", "pk",
+                                     generate_sqlite_ddl(table.schema, "pk", "t", layout), bulk=True)
+            writer.begin()
+            writer.cur.executemany(get_sqlite_insert_sql(table.schema, writer.target), arrow_rows(table))
+            writer.commit()
+            writer.finish()
+
+            conn = sqlite3.connect(db_path)
+            start = time.time()
+            for key in keys:
+                conn.execute("select * from t where pk = ?;", (key,)).fetchone()
+            cost = time.time() - start
+            conn.close()
+            print(f"{layout:>14}: {os.path.getsize(db_path) / 1024 / 1024:.1f} MiB, "
+                  f"{cost / args.lookups * 1e6:.1f} us per get")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def bench_client(args):
+    """compare the per call cost of a new boto3 client with the cached client"""
+    kwargs = {"region_name": args.region or "us-east-1",
+              "aws_access_key_id": args.access_key or "bench",
+              "aws_secret_access_key": args.secret_key or "bench"}
+    if args.endpoint != "":
+        kwargs["endpoint_url"] = args.endpoint
+    bucket = args.bucket or "s3://bench"
+    name = bucket.split("://")[-1]
+
+    def call(s3c):
+        # a real request when a bucket is given, else the client setup only
+        if args.bucket != "":
+            s3c.list_objects_v2(Bucket=name, MaxKeys=1)
+
+    def new_client():
+        call(boto3.session.Session().client('s3', config=Config(), **kwargs))
+
+    def cached_client():
+        call(get_bucket_client(bucket, **kwargs)[0])
+
+    for label, func in (("new client", new_client), ("cached client", cached_client)):
+        func()
+        start = time.time()
+        for _ in range(args.calls):
+            func()
+        cost = time.time() - start
+        print(f"{label:>14}: {cost / args.calls * 1000:.2f} ms per call")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    hash_parser = subparsers.add_parser("hash", help="murmur3 partition ids")
+    hash_parser.add_argument("--rows", type=int, default=1000000, help="row number")
+    hash_parser.add_argument("--edge_rows", type=int, default=100000,
+                             help="rows of the edge case key columns")
+    hash_parser.set_defaults(func=bench_hash)
+
+    spark_hash_parser = subparsers.add_parser("spark_hash", help="spark loader vs magicdbLoad partition ids")
+    spark_hash_parser.add_argument("--rows", type=int, default=1000000, help="row number")
+    spark_hash_parser.add_argument("--python_rows", type=int, default=20000,
+                                   help="rows checked with the pure python hash, it is slow")
+    spark_hash_parser.add_argument("--partitions", type=int, default=100, help="partition number")
+    spark_hash_parser.set_defaults(func=bench_spark_hash)
+
+    insert_parser = subparsers.add_parser("insert", help="arrow vs pandas sqlite insert")
+    insert_parser.add_argument("--rows", type=int, default=10000000, help="row number")
+    insert_parser.add_argument("--partitions", type=int, default=10, help="partition number")
+    insert_parser.set_defaults(func=bench_insert)
+
+    lookup_parser = subparsers.add_parser("lookup", help="rowid vs without rowid point get")
+    lookup_parser.add_argument("--rows", type=int, default=1000000, help="row number")
+    lookup_parser.add_argument("--lookups", type=int, default=100000, help="point get number")
+    lookup_parser.add_argument("--key_type", type=str, default="string",
+                               choices=["int64", "string"], help="type of the primary key")
+    lookup_parser.set_defaults(func=bench_lookup)
+
+    client_parser = subparsers.add_parser("client", help="new vs cached boto3 client per call")
+    client_parser.add_argument("--calls", type=int, default=100, help="call number")
+    client_parser.add_argument("--bucket", type=str, default="",
+                               help="list this bucket on every call, example: s3://bucket-name")
+    client_parser.add_argument("--access_key", type=str, default="", help="access key")
+    client_parser.add_argument("--secret_key", type=str, default="", help="secret key")
+    client_parser.add_argument("--region", type=str, default="", help="region")
+    client_parser.add_argument("--endpoint", type=str, default="", help="endpoint")
+    client_parser.set_defaults(func=bench_client)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -211,6 +211,7 @@ class MagicDBEtcdClient:
                 "versions": [],
                 "partitions": properties.get("partitions", 100),
                 "key": properties["key"],
+                "layout": properties.get("layout", "rowid"),
             }
         )
         with self.client.lock(self.locker, ttl=10):
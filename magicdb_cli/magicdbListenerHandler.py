@@ -22,9 +22,10 @@ from multiprocessing import cpu_count
 import antlr4
 import requests
 
+from magicdb_cli.bucket_util import UPLOAD_WORKERS
 from magicdb_cli.magicdbEtcdClient import MagicDBEtcdClient
 from magicdb_cli.magicdbLexer import magicdbLexer
-from magicdb_cli.magicdbLoad import to_magicdb
+from magicdb_cli.magicdbLoad import SKEW_FACTOR, to_magicdb
 from magicdb_cli.magicdbParser import magicdbParser
 from magicdb_cli.magicdbParserListener import magicdbParserListener
 
@@ -39,6 +40,13 @@ def get_engine_namespace() -> str:
     return ENGINE_NAMESPACE
 
 
+def bool_property(properties: dict, key: str, default: bool = False) -> bool:
+    value = properties.get(key, default)
+    if isinstance(value, str):
+        return value.lower() in ("true", "1", "yes")
+    return bool(value)
+
+
 class MagicDBListenerHandler(magicdbParserListener):
     def __init__(self, etcd_client: MagicDBEtcdClient) -> None:
         super().__init__()
@@ -160,6 +168,19 @@ class MagicDBListenerHandler(magicdbParserListener):
             "region_name": db_info["region"],
             "endpoint_url": db_info["endpoint"],
         }
+        if "max_pool_connections" in properties:
+            boto3_kwargs["max_pool_connections"] = int(properties["max_pool_connections"])
+
+        # a delta is applied to the given version, or to the current one
+        base_version = properties.get("base_version", "")
+        if base_version == "" and bool_property(properties, "incremental"):
+            base_version = self.etcd_client.show_current_version(database, table)
+        if base_version != "" and base_version not in table_info.get("versions", []):
+            print(f"err! version:`{base_version}` of table:`{database}.{table}` not exists")
+            return
+        if properties.get("delete_column", "") != "" and base_version == "":
+            print("err! delete_column needs base_version or incremental=true")
+            return
 
         version = to_magicdb(
             work_dir=properties.get(
@@ -174,6 +195,28 @@ class MagicDBListenerHandler(magicdbParserListener):
             table_name=table,
             key_name=table_info["key"],
             partitions=properties.get("partitions", 100),
+            batch_rows=int(properties.get("batch_rows", 0)),
+            insert_mode=properties.get("insert_mode", "arrow"),
+            engine=properties.get("engine", "raw"),
+            bulk_build=bool_property(properties, "bulk_build"),
+            vacuum=bool_property(properties, "vacuum"),
+            analyze=bool_property(properties, "analyze"),
+            layout=properties.get("layout", table_info.get("layout", "rowid")),
+            upload_workers=int(properties.get("upload_workers", UPLOAD_WORKERS)),
+            transfer={k: int(properties[k]) for k in
+                      ("multipart_threshold", "multipart_chunksize", "max_concurrency")
+                      if k in properties},
+            staging=properties.get("staging", "local"),
+            retries=int(properties.get("retries", 0)),
+            base_version=base_version,
+            delete_column=properties.get("delete_column", ""),
+            dedup=bool_property(properties, "dedup"),
+            deterministic=bool_property(properties, "deterministic"),
+            compression=properties.get("compression", ""),
+            compression_level=int(properties["compression_level"])
+            if "compression_level" in properties else None,
+            target_partition_bytes=int(properties.get("target_partition_bytes", 0)),
+            skew_factor=float(properties.get("skew_factor", SKEW_FACTOR)),
             **boto3_kwargs,
         )
         # 添加新的版本和上线新版本
@@ -212,6 +255,8 @@ class MagicDBListenerHandler(magicdbParserListener):
     def exitPair(self, ctx: magicdbParser.PairContext):
         key = ctx.STRING().getText()
         value = ctx.value().getText()
+        if ctx.value().TRUE() is not None or ctx.value().FALSE() is not None:
+            value = value.lower().capitalize()
         pair = eval("{%s:%s}" % (key, value))
         ctx.pair_ = pair
         return pair
@@ -21,21 +21,28 @@
 
 import argparse
 import json
+import math
+import multiprocessing
 import os
 import shutil
 import sqlite3
+import struct
 import time
-from concurrent.futures import ProcessPoolExecutor
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from enum import IntEnum
 from multiprocessing import cpu_count
-from typing import List
+from queue import Empty
+from typing import Callable, Iterator, List, Tuple, Union
 
-import mmh3
-import pandas as pd
+import numpy as np
 import pyarrow
+import pyarrow.ipc
 import pyarrow.parquet as pq
 
 from magicdb_cli.bucket_util import *
+from magicdb_cli.compress_util import CODEC_SUFFIXES, check_codec, decompress_file
+from magicdb_cli.hash_util import partition_ids
 
 PY_ARROW_INTEGER_TYPE = [
     pyarrow.lib.Type_INT8,
@@ -55,14 +62,74 @@ PY_ARROW_FLOAT_TYPE = [
 ]
 PY_ARROW_STRING_TYPE = [pyarrow.lib.Type_STRING, pyarrow.lib.Type_LARGE_STRING]
 
-MERGE_TABLE_SCRIPT = """#!/bin/bash -xv
-rm -rf PATH
-sqlite3 PATH <<__SQL__
-CREATE_SCRIPT
-ATTACH_SCRIPT
-INSERT_SCRIPT
-__SQL__
-"""
+TABLE_LAYOUTS = ["rowid", "without_rowid"]
+
+# local: download every parquet file before reading it, direct: read the row
+# groups from the bucket with ranged gets
+STAGINGS = ["local", "direct"]
+
+# sqlite allows 10 attached databases by default, one is kept for the heap of
+# a bulk build
+MAX_ATTACHED_DATABASES = 8
+
+# tail bytes read at once, enough for the footer of most parquet files
+PARQUET_FOOTER_PREFETCH = 64 * 1024
+
+# parquet footers read at the same time
+FOOTER_WORKERS = 16
+
+# rows per record batch of the shuffle engine when batch_rows is not set
+SHUFFLE_BATCH_ROWS = 65536
+
+# record batches buffered for every shuffle writer
+SHUFFLE_QUEUE_SIZE = 64
+
+# rows of a partition inserted between two commits of a shuffle writer, so its
+# dirty pages are written out instead of piling up in memory until the end
+SHUFFLE_COMMIT_ROWS = 65536
+
+# page cache of a shuffle writer in KiB, split between the partitions it owns,
+# with at least SHUFFLE_MIN_CACHE_KIB for every partition
+SHUFFLE_CACHE_KIB = 262144
+SHUFFLE_MIN_CACHE_KIB = 2048
+
+# seconds between two liveness checks of the shuffle processes
+SHUFFLE_POLL_SECONDS = 1.0
+
+# extra attempts of a failed conversion or merge task
+TASK_RETRIES = 0
+
+# stages of a load, in the order of the metrics summary
+LOAD_STAGES = ["download", "convert", "merge", "upload"]
+
+# parquet files read directly and larger than this are split by row group
+# into several conversion tasks
+SPLIT_BYTES = 256 * 1024 * 1024
+
+# partition file size aimed at when the partition number is planned
+TARGET_PARTITION_BYTES = 256 * 1024 * 1024
+
+# upper bound of a planned partition number
+MAX_PARTITIONS = 4096
+
+# partitions larger than this factor times the mean partition size are reported as skewed
+SKEW_FACTOR = 2.0
+
+# keys read to estimate the key cardinality
+KEY_SAMPLE_ROWS = 100000
+
+MERGE_PRAGMAS = [
+    "PRAGMA synchronous = OFF;",
+    "PRAGMA journal_mode = OFF;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -262144;",
+]
+
+# page_size must be set before the first table is created
+BULK_BUILD_PRAGMAS = [
+    "PRAGMA page_size = 16384;",
+    "PRAGMA main.locking_mode = EXCLUSIVE;",
+] + MERGE_PRAGMAS
 
 
 def pyarrow_type_to_sqlite_type(field: pyarrow.lib.Field) -> str:
@@ -125,20 +192,26 @@ def generate_features_from_schema(schema: pyarrow.Schema) -> dict:
     return feature_list
 
 
-def generate_sqlite_ddl(schema: pyarrow.Schema, key_name: str, table_name: str) -> str:
+def generate_sqlite_ddl(schema: pyarrow.Schema, key_name: str, table_name: str,
+                        layout: str = "rowid") -> str:
     """generate sqlite table ddl
 
     Args:
         schema (pyarrow.Schema): schame of parquet table
         key_name (str): primary key, str or int
         table_name (str): table name
+        layout (str, optional): rowid | without_rowid, without_rowid clusters the rows
+            on the primary key, so a TEXT key needs no separate index. Defaults to "rowid".
 
     Raises:
         TypeError: primary key type error
+        ValueError: unknown layout
 
     Returns:
         str: return ddl
     """
+    if layout not in TABLE_LAYOUTS:
+        raise ValueError(f"layout: {layout} not support")
     items = []
     for col in schema:
         col_type = pyarrow_type_to_sqlite_type(col)
@@ -148,7 +221,10 @@ def generate_sqlite_ddl(schema: pyarrow.Schema, key_name: str, table_name: str)
             items.append(f"{key_name} {col_type} PRIMARY KEY NOT NULL")
         else:
             items.append(f"{col.name} {col_type}")
-    return "create table %s (%s\n);" % (table_name, ",\n".join(items))
+    ddl = "create table %s (%s\n)" % (table_name, ",\n".join(items))
+    if layout == "without_rowid":
+        ddl += " without rowid"
+    return ddl + ";"
 
 
 def get_sqlite_insert_sql(schema: pyarrow.Schema, table_name: str) -> str:
@@ -170,27 +246,304 @@ def get_sqlite_insert_sql(schema: pyarrow.Schema, table_name: str) -> str:
     return dml
 
 
-def get_table_schema(bucket: str,
-                     path: str,
-                     work_dir: str,
-                     **kwargs: str,
-                     ) -> pyarrow.Schema:
-    """get the schema of table
+def group_partitions(pids: np.ndarray, partitions: int) -> Tuple[np.ndarray, np.ndarray]:
+    """group rows by partition id with one stable sort
 
     Args:
-        path (str): remote path
-        work_dir (str): current work dir
-        endpoint (str, optional): endpoint of s3/oss. Defaults to "".
+        pids (np.ndarray): partition id of every row
+        partitions (int): partition number
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: row order, and the partition bounds in that
+            order, rows of partition i are order[bounds[i]:bounds[i+1]]
+    """
+    counts = np.bincount(pids, minlength=partitions)
+    bounds = np.zeros(partitions + 1, dtype=np.int64)
+    np.cumsum(counts, out=bounds[1:])
+    # numpy sorts 16 bits integers with a stable radix sort, O(rows)
+    if partitions <= 1 << 16:
+        pids = pids.astype(np.uint16)
+    order = np.argsort(pids, kind="stable")
+    return order, bounds
+
+
+def read_parquet_footer(bucket: str, path: str, **kwargs: str) -> pq.FileMetaData:
+    """read the metadata of a remote parquet file from its footer only
+
+    Args:
+        bucket (str): bucket name
+        path (str): remote parquet file path
+
+    Raises:
+        ValueError: not a parquet file
+
+    Returns:
+        pq.FileMetaData: metadata of the file
+    """
+    # parquet ends with: footer, footer length (4 bytes little endian), "PAR1"
+    tail = bucket_read_tail(bucket, path, PARQUET_FOOTER_PREFETCH, **kwargs)
+    if len(tail) < 12 or tail[-4:] != b"PAR1":
+        raise ValueError(f"{path} is not a parquet file")
+    footer_length = struct.unpack("<I", tail[-8:-4])[0]
+    if footer_length + 8 > len(tail):
+        tail = bucket_read_tail(bucket, path, footer_length + 8, **kwargs)
+    footer = tail[-(footer_length + 8):]
+    return pq.read_metadata(pyarrow.BufferReader(b"PAR1" + footer))
+
+
+def read_parquet_footers(bucket: str, paths: List[str], **kwargs: str) -> List[pq.FileMetaData]:
+    """read the footers of remote parquet files in parallel
+
+    Args:
+        bucket (str): bucket name
+        paths (List[str]): remote parquet file paths
+
+    Returns:
+        List[pq.FileMetaData]: metadata of every file
+    """
+    with ThreadPoolExecutor(max_workers=FOOTER_WORKERS) as pool:
+        return list(pool.map(lambda p: read_parquet_footer(bucket, p, **kwargs), paths))
+
+
+def get_table_schema(paths: List[str], footers: List[pq.FileMetaData]) -> pyarrow.Schema:
+    """get the schema of table, all the files must have the same schema
+
+    Args:
+        paths (List[str]): remote parquet file paths
+        footers (List[pq.FileMetaData]): metadata of every file
+
+    Raises:
+        ValueError: schema mismatch
 
     Returns:
         pyarrow.Schema: return the schema
     """
+    schemas = [footer.schema.to_arrow_schema() for footer in footers]
+    mismatch = [path for path, schema in zip(paths, schemas)
+                if not schema.equals(schemas[0], check_metadata=False)]
+    if len(mismatch) > 0:
+        raise ValueError(f"schema of {mismatch} differs from {paths[0]}: {schemas[0]}")
+    return schemas[0]
+
+
+def plan_parquet_tasks(paths: List[str],
+                       footers: List[pq.FileMetaData],
+                       sizes: List[int] = None,
+                       split_bytes: int = SPLIT_BYTES,
+                       ) -> List[dict]:
+    """plan the conversion tasks of the parquet files, largest first so the pool
+    never starts a big task last (LPT scheduling)
 
-    base_name = os.path.basename(path)
-    local_file = os.path.join(work_dir, base_name)
-    bucket_download_file(bucket=bucket, remote_path=path, dst_path=local_file, **kwargs)
-    table = pq.read_table(local_file)
-    return table.schema
+    Args:
+        paths (List[str]): parquet file list
+        footers (List[pq.FileMetaData]): metadata of every parquet file
+        sizes (List[int], optional): bytes of every parquet file, the compressed
+            size of its row groups if None. Defaults to None.
+        split_bytes (int, optional): files larger than this are split into tasks of
+            consecutive row groups, 0 never splits. Defaults to SPLIT_BYTES.
+
+    Returns:
+        List[dict]: path, row_groups (None for the whole file), rows and bytes of every task
+    """
+    tasks = []
+    for i, (path, footer) in enumerate(zip(paths, footers)):
+        group_bytes = [
+            sum(footer.row_group(g).column(c).total_compressed_size
+                for c in range(footer.num_columns))
+            for g in range(footer.num_row_groups)
+        ]
+        size = sizes[i] if sizes is not None else sum(group_bytes)
+        if split_bytes <= 0 or size <= split_bytes or footer.num_row_groups <= 1:
+            tasks.append({"path": path, "row_groups": None, "rows": footer.num_rows, "bytes": size})
+            continue
+        groups, rows, nbytes = [], 0, 0
+        for g in range(footer.num_row_groups):
+            if len(groups) > 0 and nbytes + group_bytes[g] > split_bytes:
+                tasks.append({"path": path, "row_groups": groups, "rows": rows, "bytes": nbytes})
+                groups, rows, nbytes = [], 0, 0
+            groups.append(g)
+            rows += footer.row_group(g).num_rows
+            nbytes += group_bytes[g]
+        tasks.append({"path": path, "row_groups": groups, "rows": rows, "bytes": nbytes})
+    tasks.sort(key=lambda t: t["bytes"], reverse=True)
+    return tasks
+
+
+def sample_key_ratio(bucket: str, path: str, key_name: str, **kwargs: str) -> float:
+    """estimate the ratio of distinct keys from the first row group of a parquet
+    file, only the key column is fetched with ranged gets
+
+    Args:
+        bucket (str): bucket name
+        path (str): remote parquet file path
+        key_name (str): primary key
+
+    Returns:
+        float: distinct keys / rows of the sample, 1.0 for an empty file
+    """
+    pf, _, _ = open_parquet(bucket, path, work_dir="", staging="direct", **kwargs)
+    if pf.metadata.num_row_groups == 0:
+        return 1.0
+    keys = pf.read_row_group(0, columns=[key_name]).column(0).slice(0, KEY_SAMPLE_ROWS)
+    if len(keys) == 0:
+        return 1.0
+    return len(keys.unique()) / len(keys)
+
+
+def plan_partitions(footers: List[pq.FileMetaData],
+                    target_bytes: int = TARGET_PARTITION_BYTES,
+                    key_ratio: float = 1.0,
+                    max_partitions: int = MAX_PARTITIONS) -> dict:
+    """pick the partition number from the parquet footers, the uncompressed bytes of
+    the row groups scaled by the key ratio estimate the size of the table
+
+    Args:
+        footers (List[pq.FileMetaData]): metadata of every file
+        target_bytes (int, optional): partition file size aimed at. Defaults to TARGET_PARTITION_BYTES.
+        key_ratio (float, optional): distinct keys / rows, see sample_key_ratio. Defaults to 1.0.
+        max_partitions (int, optional): upper bound of the partition number. Defaults to MAX_PARTITIONS.
+
+    Returns:
+        dict: partitions, rows, key_ratio, estimated_bytes and target_bytes
+    """
+    rows = sum(f.num_rows for f in footers)
+    nbytes = sum(f.row_group(i).total_byte_size for f in footers for i in range(f.num_row_groups))
+    estimated_bytes = int(nbytes * key_ratio)
+    partitions = min(max(math.ceil(estimated_bytes / target_bytes), 1), max_partitions)
+    return {"partitions": partitions, "rows": rows, "key_ratio": round(key_ratio, 4),
+            "estimated_bytes": estimated_bytes, "target_bytes": target_bytes}
+
+
+def partition_size_distribution(sizes: List[int]) -> dict:
+    """summarize the partition file sizes
+
+    Args:
+        sizes (List[int]): bytes of every partition file
+
+    Returns:
+        dict: min, mean, p50, p95 and max bytes
+    """
+    if len(sizes) == 0:
+        return {}
+    sizes = np.asarray(sizes, dtype=np.int64)
+    return {"min": int(sizes.min()), "mean": int(sizes.mean()),
+            "p50": int(np.percentile(sizes, 50)), "p95": int(np.percentile(sizes, 95)),
+            "max": int(sizes.max())}
+
+
+def check_partition_skew(sizes: List[int], skew_factor: float = SKEW_FACTOR) -> List[int]:
+    """find the partitions larger than skew_factor times the mean size and warn about them
+
+    Args:
+        sizes (List[int]): bytes of every partition file, None for unknown sizes
+        skew_factor (float, optional): allowed size over the mean size. Defaults to SKEW_FACTOR.
+
+    Returns:
+        List[int]: skewed partition ids
+    """
+    known = [s for s in sizes if s is not None]
+    if len(known) == 0:
+        return []
+    threshold = skew_factor * np.mean(known)
+    skewed = [i for i, s in enumerate(sizes) if s is not None and s > threshold]
+    if len(skewed) > 0:
+        print(f"warning: {len(skewed)} partitions over {skew_factor} times the mean size "
+              f"{np.mean(known) / MB:.1f} MiB, the largest: "
+              + ", ".join(f"{i} ({sizes[i] / MB:.1f} MiB)"
+                          for i in sorted(skewed, key=lambda i: -sizes[i])[:10]))
+    return skewed
+
+
+def open_parquet(bucket: str, path: str, work_dir: str, staging: str = "local",
+                 **kwargs: str) -> Tuple[pq.ParquetFile, str, dict]:
+    """open a remote parquet file for reading
+
+    Args:
+        bucket (str): bucket name
+        path (str): remote parquet file path
+        work_dir (str): where to download the parquet file
+        staging (str, optional): local | direct, download the file first or read it
+            from the bucket. Defaults to "local".
+
+    Raises:
+        ValueError: unknown staging
+
+    Returns:
+        Tuple[pq.ParquetFile, str, dict]: the parquet file, its local copy, None if read
+            directly, and the bytes and seconds fetched from the bucket, updated while
+            a direct file is read
+    """
+    if staging == "local":
+        start = time.time()
+        local_parquet_file = os.path.join(work_dir, os.path.basename(path))
+        if os.path.exists(local_parquet_file):
+            os.remove(local_parquet_file)
+        bucket_download_file(bucket=bucket, remote_path=path, dst_path=local_parquet_file, **kwargs)
+        download = {"bytes": os.path.getsize(local_parquet_file), "seconds": time.time() - start}
+        return pq.ParquetFile(local_parquet_file), local_parquet_file, download
+    if staging == "direct":
+        # pre buffering fetches the column chunks of a row group in a few coalesced ranges
+        source = BucketFile(bucket, path, **kwargs)
+        return pq.ParquetFile(source, pre_buffer=True), None, source.stats
+    raise ValueError(f"staging: {staging} not support")
+
+
+def arrow_rows(data: Union[pyarrow.Table, pyarrow.RecordBatch],
+               chunk_rows: int = 65536) -> Iterator[tuple]:
+    """iterate the rows of arrow data as tuples, built column-wise per chunk
+
+    Args:
+        data (Union[pyarrow.Table, pyarrow.RecordBatch]): arrow data
+        chunk_rows (int, optional): rows converted at once. Defaults to 65536.
+
+    Yields:
+        Iterator[tuple]: row values
+    """
+    for start in range(0, data.num_rows, chunk_rows):
+        chunk = data.slice(start, chunk_rows)
+        yield from zip(*[column.to_pylist() for column in chunk.columns])
+
+
+def write_partitioned_rows(
+        cur: sqlite3.Cursor,
+        dmls: List[str],
+        data: Union[pyarrow.Table, pyarrow.RecordBatch],
+        key_name: str,
+        partitions: int,
+        insert_mode: str = "arrow",
+) -> np.ndarray:
+    """hash the rows and write them to their partition tables
+
+    Args:
+        cur (sqlite3.Cursor): cursor of the raw sqlite file
+        dmls (List[str]): insert sql of every partition table
+        data (Union[pyarrow.Table, pyarrow.RecordBatch]): rows to write
+        key_name (str): primary key
+        partitions (int): how many tables to split
+        insert_mode (str, optional): arrow | pandas, how rows are fed to sqlite. Defaults to "arrow".
+
+    Raises:
+        ValueError: unknown insert mode
+
+    Returns:
+        np.ndarray: rows written to every partition
+    """
+    order, bounds = group_partitions(
+        partition_ids(data.column(key_name), partitions), partitions)
+    data = data.take(order)
+
+    # rows of partition i are rows[bounds[i]:bounds[i+1]]
+    if insert_mode == "arrow":
+        for i in range(partitions):
+            rows = data.slice(bounds[i], bounds[i + 1] - bounds[i])
+            cur.executemany(dmls[i], arrow_rows(rows))
+    elif insert_mode == "pandas":
+        rows = data.to_pandas().to_numpy()
+        for i in range(partitions):
+            cur.executemany(dmls[i], rows[bounds[i]: bounds[i + 1]])
+    else:
+        raise ValueError(f"insert mode: {insert_mode} not support")
+    return np.diff(bounds)
 
 
 def parquet_to_raw_sqlite(
@@ -201,8 +554,12 @@ def parquet_to_raw_sqlite(
         table_name: str,
         work_dir: str,
         partitions: int,
+        batch_rows: int = 0,
+        insert_mode: str = "arrow",
+        staging: str = "local",
+        row_groups: List[int] = None,
         **kwargs: str,
-):
+) -> dict:
     """transform parquet file tp sqlite file
 
     Args:
@@ -213,19 +570,30 @@ def parquet_to_raw_sqlite(
         table_name (str): table name
         work_dir (str): current work dir
         partitions (int, optional): _description_. Defaults to 100.
+        batch_rows (int, optional): rows read per record batch, 0 reads the whole file. Defaults to 0.
+        insert_mode (str, optional): arrow | pandas, how rows are fed to sqlite. Defaults to "arrow".
+        staging (str, optional): local | direct, download the parquet file first or read it
+            from the bucket. Defaults to "local".
+        row_groups (List[int], optional): row groups to transform, the whole file if None.
+            Defaults to None.
+
+    Returns:
+        dict: sqlite file path, rows, rows of every partition, seconds of the task,
+            and bytes and seconds of the download
     """
+    start = time.time()
     base_name = os.path.basename(path)
-    local_parquet_file = os.path.join(work_dir, base_name)
+    if row_groups is not None:
+        base_name = f"{base_name}.{row_groups[0]}"
     db_path = os.path.join(work_dir, f"{base_name}.db")
     ddls, dmls = [], []
     print(f"processing parquet file: {path} to sqlite: {db_path}...")
 
     if os.path.exists(db_path):
         os.remove(db_path)
-    if os.path.exists(local_parquet_file):
-        os.remove(local_parquet_file)
 
-    bucket_download_file(bucket=bucket, remote_path=path, dst_path=local_parquet_file, **kwargs)
+    parquet_file, local_parquet_file, download = open_parquet(
+        bucket, path, work_dir, staging, **kwargs)
 
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
@@ -244,171 +612,805 @@ def parquet_to_raw_sqlite(
     cur.execute("""PRAGMA synchronous = OFF;""")
     cur.execute("""PRAGMA journal_mode = OFF;""")
 
-    def hash_func(x):
-        return mmh3.hash64(str(x[key_name]), signed=False)[0] % partitions
-
-    df = pd.read_parquet(path=local_parquet_file)
-    df[bucket] = df.apply(hash_func, axis=1)
-
-    # write data to sqlite
-    for i in range(partitions):
-        tmp = df[df[bucket] == i]
-        del tmp[bucket]
-        data = tmp.to_numpy()
-        cur.executemany(dmls[i], data)
+    # write data to sqlite, streaming keeps at most one batch in memory
+    partition_rows = np.zeros(partitions, dtype=np.int64)
+    if batch_rows > 0:
+        for batch in parquet_file.iter_batches(batch_size=batch_rows, row_groups=row_groups):
+            partition_rows += write_partitioned_rows(cur, dmls, batch, key_name, partitions, insert_mode)
+            conn.commit()
+    else:
+        if row_groups is not None:
+            table = parquet_file.read_row_groups(row_groups)
+        else:
+            table = parquet_file.read()
+        partition_rows += write_partitioned_rows(cur, dmls, table, key_name, partitions, insert_mode)
         conn.commit()
     cur.close()
     conn.close()
-    print(f"finish processing parquet file: {path} to sqlite: {db_path}")
+    if local_parquet_file is not None:
+        os.remove(local_parquet_file)
+    seconds = time.time() - start
+    print(f"finish processing parquet file: {path} to sqlite: {db_path}, {seconds:.2f}s")
+    return {
+        "path": db_path,
+        "rows": int(partition_rows.sum()),
+        "partition_rows": partition_rows.tolist(),
+        "seconds": seconds,
+        "download_bytes": download["bytes"],
+        "download_seconds": download["seconds"],
+    }
+
+
+def run_tasks(
+        func: Callable,
+        tasks: List[tuple],
+        worker: int,
+        retries: int = TASK_RETRIES,
+        callback: Callable = None,
+        **kwargs,
+) -> list:
+    """run func(*task, **kwargs) of every task in a process pool, a failed task is
+    submitted again up to retries times, then the pending tasks are cancelled and
+    its error is raised
+
+    Args:
+        func (Callable): task function
+        tasks (List[tuple]): positional arguments of every task, submitted in this order
+        worker (int): work number
+        retries (int, optional): extra attempts of a failed task. Defaults to TASK_RETRIES.
+        callback (Callable, optional): called with the result of every task as soon as
+            it is done. Defaults to None.
+
+    Returns:
+        list: results of the tasks, in the order of tasks
+    """
+    pool = ProcessPoolExecutor(max_workers=worker)
+    futures = {pool.submit(func, *task, **kwargs): (i, 0) for i, task in enumerate(tasks)}
+    results = [None] * len(tasks)
+    try:
+        while len(futures) > 0:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, attempt = futures.pop(future)
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    if attempt >= retries:
+                        raise
+                    print(f"task {i} of {func.__name__} failed: {e}, "
+                          f"retry {attempt + 1}/{retries}")
+                    futures[pool.submit(func, *tasks[i], **kwargs)] = (i, attempt + 1)
+                    continue
+                if callback is not None:
+                    callback(results[i])
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=True)
+    return results
 
 
 def parquets_to_raw_sqlites(
         schema: pyarrow.Schema,
         bucket: str,
-        input_files: List[str],
+        tasks: List[dict],
         output_dir: str,
         key_name: str,
         table_name: str,
         worker: int,
         partitions: int = 100,
+        batch_rows: int = 0,
+        insert_mode: str = "arrow",
+        staging: str = "local",
+        retries: int = TASK_RETRIES,
         **kwargs: str,
-) -> List[str]:
+) -> List[dict]:
     """transform all parquet files to sqlite files
 
     Args:
         schema (pyarrow.Schema): parquet schema
         bucket (str): bucket name
-        input_files (List[str]): parquet file list
+        tasks (List[dict]): path and row_groups of every task, see plan_parquet_tasks,
+            submitted in this order
         output_dir (str): where to put the sqlite files
         key_name (str): primary key
         table_name (str): table name
         worker (int): work number
         partitions (int, optional): how many tables to split. Defaults to 100.
+        batch_rows (int, optional): rows read per record batch, 0 reads the whole file. Defaults to 0.
+        insert_mode (str, optional): arrow | pandas, how rows are fed to sqlite. Defaults to "arrow".
+        staging (str, optional): local | direct, download the parquet files first or read them
+            from the bucket. Defaults to "local".
+        retries (int, optional): extra attempts of a failed file. Defaults to TASK_RETRIES.
 
     Returns:
-        List[str]: return the sqlite file list
+        List[dict]: return the stats of every sqlite file, see parquet_to_raw_sqlite
     """
-    output_files = []
-    pool = ProcessPoolExecutor(max_workers=worker)
-    for i in range(len(input_files)):
-        base_name = os.path.basename(input_files[i])
-        local_file = os.path.join(output_dir, f"{base_name}.db")
-        output_files.append(local_file)
-        pool.submit(
-            parquet_to_raw_sqlite,
-            bucket,
-            input_files[i],
-            schema,
-            key_name,
-            table_name,
-            output_dir,
-            partitions,
-            **kwargs,
-        )
-    pool.shutdown(wait=True)
-    return output_files
+    return run_tasks(
+        parquet_to_raw_sqlite,
+        [(bucket, task["path"], schema, key_name, table_name, output_dir, partitions,
+          batch_rows, insert_mode, staging, task["row_groups"]) for task in tasks],
+        worker,
+        retries,
+        **kwargs,
+    )
+
+
+def normalize_sqlite_header(path: str):
+    """reset the header counters bumped by every write, the file change counter
+    and the version-valid-for number, both to 1 so the in-header database size
+    stays valid
+
+    Args:
+        path (str): closed sqlite file
+    """
+    with open(path, "r+b") as f:
+        f.seek(24)
+        f.write(struct.pack(">I", 1))
+        f.seek(92)
+        f.write(struct.pack(">I", 1))
+
+
+class PartitionWriter:
+    """sqlite file of one table partition
+
+    In bulk mode rows go to a heap table without primary key in a scratch file
+    attached next to the partition file, and finish copies them to the table in
+    key order, so the primary key b-tree is appended to instead of being
+    inserted at random, and no page of the heap is left in the partition file.
+
+    A deterministic build is a bulk build whose file is rewritten by VACUUM INTO
+    and normalized, so the same rows give the same bytes whatever order they
+    were written in.
+    """
+
+    def __init__(self,
+                 path: str,
+                 table_name: str,
+                 key_name: str,
+                 ddl: str,
+                 bulk: bool = False,
+                 vacuum: bool = False,
+                 analyze: bool = False,
+                 deterministic: bool = False,
+                 ) -> None:
+        self.path = path
+        self.table_name = table_name
+        self.key_name = key_name
+        self.bulk = bulk = bulk or deterministic
+        self.deterministic = deterministic
+        self.vacuum = vacuum
+        self.analyze = analyze
+        self.heap_path = f"{path}.heap"
+        self.target = f"heap.{table_name}_heap" if bulk else table_name
+
+        for p in (path, self.heap_path):
+            if os.path.exists(p):
+                os.remove(p)
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.cur = self.conn.cursor()
+        for pragma in BULK_BUILD_PRAGMAS if bulk else MERGE_PRAGMAS:
+            self.cur.execute(pragma)
+        self.cur.execute(ddl)
+        if bulk:
+            self.cur.execute("attach database ? as heap;", (self.heap_path,))
+            self.cur.execute("PRAGMA heap.synchronous = OFF;")
+            self.cur.execute("PRAGMA heap.journal_mode = OFF;")
+            self.cur.execute(
+                f"create table {self.target} as select * from main.{table_name} where 0;")
+
+    def begin(self):
+        self.cur.execute("begin;")
+
+    def commit(self):
+        self.cur.execute("commit;")
+
+    def finish(self) -> int:
+        """move the heap rows in key order and close the file
+
+        Returns:
+            int: row number of the partition
+        """
+        if self.bulk:
+            self.begin()
+            self.cur.execute(
+                f"insert into main.{self.table_name} select * from {self.target} "
+                f"order by {self.key_name};")
+            self.commit()
+            self.cur.execute("detach database heap;")
+            os.remove(self.heap_path)
+        if self.analyze:
+            self.cur.execute("analyze;")
+        rows = self.cur.execute(f"select count(*) from {self.table_name};").fetchone()[0]
+        compact_path = f"{self.path}.compact"
+        if self.deterministic:
+            # a fresh file has no free pages nor write history of the heap
+            if os.path.exists(compact_path):
+                os.remove(compact_path)
+            self.cur.execute("vacuum into ?;", (compact_path,))
+        elif self.vacuum:
+            self.cur.execute("vacuum;")
+        self.cur.close()
+        self.conn.close()
+        if self.deterministic:
+            os.replace(compact_path, self.path)
+            normalize_sqlite_header(self.path)
+        return rows
 
 
 def build_table_partition(
         output_dir: str,
-        bash_dir: str,
         partition: int,
         table_name: str,
+        key_name: str,
         ddl: str,
         inputs: List[str],
-):
+        attach_batch: int = MAX_ATTACHED_DATABASES,
+        **build_options: bool,
+) -> dict:
     """build partition data of this table
 
     Args:
         output_dir (str): where to put the partition data
-        bash_dir (str): where to put bash file
-        partition (int): how many tables to split
+        partition (int): index of this partition
         table_name (str): table name
+        key_name (str): primary key
         ddl (str): to create the sqlite table
         inputs (List[str]): origin sqlite input files
+        attach_batch (int, optional): input files attached at once. Defaults to MAX_ATTACHED_DATABASES.
+        build_options: bulk, vacuum, analyze and deterministic of PartitionWriter
+
+    Returns:
+        dict: partition, path, rows, bytes and seconds of the build
     """
+    start = time.time()
     index_str = "{:0>5d}".format(partition)
     local_path = os.path.join(output_dir, f"{index_str}.db")
+    writer = PartitionWriter(local_path, table_name, key_name, ddl, **build_options)
+
+    # sqlite can not attach inside a transaction, so every batch of
+    # attached inputs is merged in a transaction of its own
+    cur = writer.cur
+    for begin in range(0, len(inputs), attach_batch):
+        batch = inputs[begin: begin + attach_batch]
+        for i, sfile in enumerate(batch):
+            cur.execute(f"attach database ? as data_{i};", (sfile,))
+        writer.begin()
+        for i in range(len(batch)):
+            cur.execute(
+                f"insert into {writer.target} select * from data_{i}.{table_name}_{partition};")
+        writer.commit()
+        for i in range(len(batch)):
+            cur.execute(f"detach database data_{i};")
+    rows = writer.finish()
+
+    cost = time.time() - start
+    print(f"finish building partition: {local_path}, rows: {rows}, cost: {cost:.2f}s")
+    return {"partition": partition, "path": local_path, "rows": rows,
+            "bytes": os.path.getsize(local_path), "seconds": cost}
+
+
+def apply_delta_partition(
+        output_dir: str,
+        partition: int,
+        table_name: str,
+        key_name: str,
+        columns: List[str],
+        delete_column: str,
+        bucket: str,
+        base_path: str,
+        inputs: List[str],
+        vacuum: bool = False,
+        analyze: bool = False,
+        deterministic: bool = False,
+        **kwargs: str,
+) -> dict:
+    """copy a partition of the base version and apply the delta rows of this partition
 
-    # generate bash script files and then use bash to merge sqlites
-    attach_items, insert_items = [], []
-    for i, sfile in enumerate(inputs):
-        attach_items.append(f"attach database '{sfile}' as 'data_{i}';")
-        insert_items.append(
-            f"insert into {table_name} select * from data_{i}.{table_name}_{partition};"
-        )
-    attach_script = "\n".join(attach_items)
-    insert_script = "\n".join(insert_items)
+    Args:
+        output_dir (str): where to put the partition data
+        partition (int): index of this partition
+        table_name (str): table name
+        key_name (str): primary key
+        columns (List[str]): columns of the table
+        delete_column (str): integer column of the delta, rows with a non zero value
+            delete their key, "" if the delta only upserts
+        bucket (str): bucket name
+        base_path (str): remote partition file of the base version, decompressed by the
+            suffix of its codec
+        inputs (List[str]): raw sqlite files of the delta
+        vacuum (bool, optional): vacuum the partition file. Defaults to False.
+        analyze (bool, optional): analyze the partition file. Defaults to False.
+        deterministic (bool, optional): rewrite the file with VACUUM INTO and normalize
+            its header. Defaults to False.
 
-    bash_script = (
-        MERGE_TABLE_SCRIPT.replace("ATTACH_SCRIPT", attach_script)
-        .replace("PATH", local_path)
-        .replace("INSERT_SCRIPT", insert_script)
-        .replace("CREATE_SCRIPT", ddl)
-    )
+    Returns:
+        dict: partition, path, rows, bytes and seconds of the build
+    """
+    start = time.time()
+    index_str = "{:0>5d}".format(partition)
+    local_path = os.path.join(output_dir, f"{index_str}.db")
+    if os.path.exists(local_path):
+        os.remove(local_path)
+    codec = next((c for c, suffix in CODEC_SUFFIXES.items() if base_path.endswith(suffix)), None)
+    if codec is None:
+        bucket_download_file(bucket=bucket, remote_path=base_path, dst_path=local_path, **kwargs)
+    else:
+        compressed_path = local_path + CODEC_SUFFIXES[codec]
+        bucket_download_file(bucket=bucket, remote_path=base_path, dst_path=compressed_path, **kwargs)
+        decompress_file(compressed_path, local_path, codec)
+        os.remove(compressed_path)
+
+    conn = sqlite3.connect(local_path, isolation_level=None)
+    cur = conn.cursor()
+    for pragma in MERGE_PRAGMAS:
+        cur.execute(pragma)
+    names = ",".join(columns)
+    upsert = f"insert or replace into {table_name} ({names}) select {names} from %s"
+    if delete_column != "":
+        upsert += f" where not coalesce({delete_column}, 0)"
+    for begin in range(0, len(inputs), MAX_ATTACHED_DATABASES):
+        batch = inputs[begin: begin + MAX_ATTACHED_DATABASES]
+        for i, sfile in enumerate(batch):
+            cur.execute(f"attach database ? as data_{i};", (sfile,))
+        cur.execute("begin;")
+        for i in range(len(batch)):
+            source = f"data_{i}.{table_name}_{partition}"
+            if delete_column != "":
+                cur.execute(f"delete from {table_name} where {key_name} in "
+                            f"(select {key_name} from {source} where coalesce({delete_column}, 0));")
+            cur.execute(upsert % source + ";")
+        cur.execute("commit;")
+        for i in range(len(batch)):
+            cur.execute(f"detach database data_{i};")
+    if analyze:
+        cur.execute("analyze;")
+    rows = cur.execute(f"select count(*) from {table_name};").fetchone()[0]
+    compact_path = f"{local_path}.compact"
+    if deterministic:
+        if os.path.exists(compact_path):
+            os.remove(compact_path)
+        cur.execute("vacuum into ?;", (compact_path,))
+    elif vacuum:
+        cur.execute("vacuum;")
+    cur.close()
+    conn.close()
+    if deterministic:
+        os.replace(compact_path, local_path)
+        normalize_sqlite_header(local_path)
+
+    cost = time.time() - start
+    print(f"finish applying delta to partition: {local_path}, rows: {rows}, cost: {cost:.2f}s")
+    return {"partition": partition, "path": local_path, "rows": rows,
+            "bytes": os.path.getsize(local_path), "seconds": cost}
 
-    bash_file = os.path.join(bash_dir, f"bash_{partition}.sh")
-    f = open(bash_file, "w")
-    f.write(bash_script)
-    f.close()
-    os.system(f"bash {bash_file}")
+
+def apply_delta(
+        table_name: str,
+        key_name: str,
+        columns: List[str],
+        delete_column: str,
+        bucket: str,
+        base_partitions: List[str],
+        input_files: List[str],
+        output_dir: str,
+        partition_rows: List[int],
+        worker: int,
+        callback: Callable[[dict], None] = None,
+        retries: int = TASK_RETRIES,
+        vacuum: bool = False,
+        analyze: bool = False,
+        deterministic: bool = False,
+        **kwargs: str,
+) -> List[dict]:
+    """rebuild the partitions with delta rows, the largest deltas first
+
+    Args:
+        table_name (str): table name
+        key_name (str): primary key
+        columns (List[str]): columns of the table
+        delete_column (str): integer column of the delta marking deletes, "" if none
+        bucket (str): bucket name
+        base_partitions (List[str]): remote partition files of the base version
+        input_files (List[str]): raw sqlite files of the delta
+        output_dir (str): where to put the table data
+        partition_rows (List[int]): delta rows of every partition, partitions without
+            rows are not rebuilt
+        worker (int): work number to process
+        callback (Callable[[dict], None], optional): called with the stats of every
+            partition as soon as it is built. Defaults to None.
+        retries (int, optional): extra attempts of a failed partition. Defaults to TASK_RETRIES.
+        vacuum (bool, optional): vacuum the partition files. Defaults to False.
+        analyze (bool, optional): analyze the partition files. Defaults to False.
+        deterministic (bool, optional): rewrite the files with VACUUM INTO and normalize
+            their headers. Defaults to False.
+
+    Returns:
+        List[dict]: return the stats of every rebuilt partition
+    """
+    order = [i for i in range(len(base_partitions)) if partition_rows[i] > 0]
+    order.sort(key=lambda i: partition_rows[i], reverse=True)
+    stats = run_tasks(
+        apply_delta_partition,
+        [(output_dir, i, table_name, key_name, columns, delete_column, bucket,
+          base_partitions[i], input_files, vacuum, analyze, deterministic) for i in order],
+        worker,
+        retries,
+        callback,
+        **kwargs,
+    )
+    stats.sort(key=lambda s: s["partition"])
+    print(f"finish applying delta to table: {table_name}, partitions: "
+          f"{len(stats)}/{len(base_partitions)}, rows: {sum(s['rows'] for s in stats)}")
+    return stats
 
 
 def r_listfiles(bucket: str,
                 path: str,
                 **kwargs: str,
-                ) -> List[str]:
-    """list the file on oss/s3
+                ) -> List[dict]:
+    """list the data files on oss/s3, largest first
 
     Args:
         path (str): remote oss/s3 dir
         endpoint (str, optional): endpoint of oss/s3. Defaults to "".
 
     Returns:
-        List[str]: files in remote dir
+        List[dict]: key, size and etag of the files in remote dir, markers like
+            _SUCCESS, hidden and empty files are skipped
     """
-    return bucket_list_file_on_cur_dir(bucket=bucket, prefix=path, **kwargs)
+    files = []
+    for o in bucket_list_objects(bucket=bucket, prefix=path, **kwargs):
+        base_name = os.path.basename(o["key"])
+        if o["size"] == 0 or base_name.startswith("_") or base_name.startswith("."):
+            continue
+        files.append(o)
+    files.sort(key=lambda o: o["size"], reverse=True)
+    return files
 
 
 def build_table(
         table_name: str,
+        key_name: str,
         ddl: str,
         input_files: List[str],
         output_dir: str,
-        bash_dir: str,
         partitions: int,
         worker: int,
-) -> List[str]:
+        callback: Callable[[dict], None] = None,
+        partition_rows: List[int] = None,
+        retries: int = TASK_RETRIES,
+        **build_options: bool,
+) -> List[dict]:
     """build table data
 
     Args:
         table_name (str): table name
+        key_name (str): primary key
         ddl (str): create table
         input_files (List[str]): origin sqlite files
         output_dir (str): where to put the table data
-        bash_dir (str): where to put the bash file
         partitions (int): how many tables to split
         worker (int): work number to process
+        callback (Callable[[dict], None], optional): called with the stats of every
+            partition as soon as it is built. Defaults to None.
+        partition_rows (List[int], optional): estimated rows of every partition, the
+            largest partitions are built first. Defaults to None.
+        retries (int, optional): extra attempts of a failed partition. Defaults to TASK_RETRIES.
+        build_options: bulk, vacuum, analyze and deterministic of PartitionWriter
 
     Returns:
-        List[str]: return table partition files
+        List[dict]: return the stats of every partition, see build_table_partition
     """
-    pool = ProcessPoolExecutor(max_workers=worker)
-    output_files = []
-    for i in range(partitions):
-        index_str = "{:0>5d}".format(i)
-        output_files.append(os.path.join(output_dir, f"{index_str}.db"))
-        pool.submit(
-            build_table_partition,
-            output_dir,
-            bash_dir,
-            i,
-            table_name,
-            ddl,
-            input_files,
+    order = list(range(partitions))
+    if partition_rows is not None:
+        order.sort(key=lambda i: partition_rows[i], reverse=True)
+    stats = run_tasks(
+        build_table_partition,
+        [(output_dir, i, table_name, key_name, ddl, input_files) for i in order],
+        worker,
+        retries,
+        callback,
+        **build_options,
+    )
+    stats.sort(key=lambda s: s["partition"])
+    print(f"finish building table: {table_name}, partitions: {partitions}, "
+          f"rows: {sum(s['rows'] for s in stats)}")
+    return stats
+
+
+def serialize_batch(batch: Union[pyarrow.Table, pyarrow.RecordBatch]) -> bytes:
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def shuffle_reader(
+        bucket: str,
+        files: multiprocessing.Queue,
+        queues: List[multiprocessing.Queue],
+        reports: multiprocessing.Queue,
+        key_name: str,
+        work_dir: str,
+        partitions: int,
+        batch_rows: int,
+        staging: str = "local",
+        **kwargs: str,
+):
+    """read parquet files, hash the rows and send every partition slice to its writer
+
+    Args:
+        bucket (str): bucket name
+        files (multiprocessing.Queue): path and row_groups of the tasks, None to stop
+        queues (List[multiprocessing.Queue]): queues of the writers
+        reports (multiprocessing.Queue): where to put the stats of the tasks read, or the
+            error of this reader
+        key_name (str): primary key
+        work_dir (str): where to download the parquet files
+        partitions (int): how many tables to split
+        batch_rows (int): rows read per record batch
+        staging (str, optional): local | direct, download the parquet files first or read them
+            from the bucket. Defaults to "local".
+    """
+    stats = []
+    try:
+        for path, row_groups in iter(files.get, None):
+            start, rows = time.time(), 0
+            parquet_file, local_parquet_file, download = open_parquet(
+                bucket, path, work_dir, staging, **kwargs)
+            for batch in parquet_file.iter_batches(batch_size=batch_rows, row_groups=row_groups):
+                order, bounds = group_partitions(
+                    partition_ids(batch.column(key_name), partitions), partitions)
+                batch = batch.take(order)
+                rows += batch.num_rows
+                for i in range(partitions):
+                    if bounds[i + 1] > bounds[i]:
+                        part = batch.slice(bounds[i], bounds[i + 1] - bounds[i])
+                        queues[i % len(queues)].put((i, serialize_batch(part)))
+            if local_parquet_file is not None:
+                os.remove(local_parquet_file)
+            seconds = time.time() - start
+            stats.append({"path": path, "rows": rows, "seconds": seconds,
+                          "download_bytes": download["bytes"],
+                          "download_seconds": download["seconds"]})
+            print(f"finish shuffling parquet file: {path}, row groups: "
+                  f"{'all' if row_groups is None else row_groups}, {seconds:.2f}s")
+    except Exception:
+        stats = traceback.format_exc()
+        raise
+    finally:
+        reports.put(stats)
+        for queue in queues:
+            queue.put(None)
+
+
+def shuffle_writer(
+        writer: int,
+        queue: multiprocessing.Queue,
+        results: multiprocessing.Queue,
+        readers: int,
+        output_dir: str,
+        schema: pyarrow.Schema,
+        table_name: str,
+        key_name: str,
+        ddl: str,
+        partitions: int,
+        writers: int,
+        build_options: dict,
+):
+    """own the final files of partitions writer, writer + writers, ... and
+    insert the slices sent by the readers
+
+    Args:
+        writer (int): index of this writer
+        queue (multiprocessing.Queue): (partition, arrow ipc bytes) to write
+        results (multiprocessing.Queue): where to put the partition stats
+        readers (int): reader number, one None is received from every reader
+        output_dir (str): where to put the partition data
+        schema (pyarrow.Schema): parquet schema
+        table_name (str): table name
+        key_name (str): primary key
+        ddl (str): to create the sqlite table
+        partitions (int): how many tables to split
+        writers (int): writer number
+        build_options (dict): bulk, vacuum, analyze and deterministic of PartitionWriter
+    """
+    # the slices of the partitions are interleaved, so the seconds of every
+    # partition are its inserts plus its finish
+    files, seconds, pending = {}, {}, {}
+    finished = 0
+    owned = range(writer, partitions, writers)
+    cache_kib = max(SHUFFLE_CACHE_KIB // max(len(owned), 1), SHUFFLE_MIN_CACHE_KIB)
+    try:
+        for i in owned:
+            start = time.time()
+            index_str = "{:0>5d}".format(i)
+            local_path = os.path.join(output_dir, f"{index_str}.db")
+            files[i] = PartitionWriter(local_path, table_name, key_name, ddl, **build_options)
+            # a bulk build splits the cache of its partition with its heap
+            schemas = ["main", "heap"] if files[i].bulk else ["main"]
+            for name in schemas:
+                files[i].cur.execute(f"PRAGMA {name}.cache_size = -{cache_kib // len(schemas)};")
+            files[i].begin()
+            seconds[i] = time.time() - start
+            pending[i] = 0
+        dml = get_sqlite_insert_sql(schema=schema, table_name=files[writer].target)
+
+        while finished < readers:
+            item = queue.get()
+            if item is None:
+                finished += 1
+                continue
+            i, data = item
+            start = time.time()
+            for batch in pyarrow.ipc.open_stream(data):
+                files[i].cur.executemany(dml, arrow_rows(batch))
+                pending[i] += batch.num_rows
+            if pending[i] >= SHUFFLE_COMMIT_ROWS:
+                files[i].commit()
+                files[i].begin()
+                pending[i] = 0
+            seconds[i] += time.time() - start
+
+        stats = []
+        for i, pfile in files.items():
+            start = time.time()
+            pfile.commit()
+            rows = pfile.finish()
+            stats.append({"partition": i, "path": pfile.path, "rows": rows,
+                          "bytes": os.path.getsize(pfile.path),
+                          "seconds": seconds[i] + time.time() - start})
+        results.put(stats)
+    except Exception:
+        results.put(traceback.format_exc())
+        # keep draining so that the readers never block on a full queue
+        while finished < readers:
+            if queue.get() is None:
+                finished += 1
+
+
+def shuffle_to_partitions(
+        schema: pyarrow.Schema,
+        bucket: str,
+        tasks: List[dict],
+        work_dir: str,
+        output_dir: str,
+        key_name: str,
+        table_name: str,
+        ddl: str,
+        worker: int,
+        partitions: int = 100,
+        batch_rows: int = 0,
+        build_options: dict = None,
+        callback: Callable[[dict], None] = None,
+        staging: str = "local",
+        **kwargs: str,
+) -> Tuple[List[dict], List[dict]]:
+    """build the partition files in one pass, readers hash partition the parquet
+    record batches and stream them to writers owning the final sqlite files
+
+    Args:
+        schema (pyarrow.Schema): parquet schema
+        bucket (str): bucket name
+        tasks (List[dict]): path and row_groups of every task, see plan_parquet_tasks,
+            read in this order
+        work_dir (str): where to download the parquet files
+        output_dir (str): where to put the table data
+        key_name (str): primary key
+        table_name (str): table name
+        ddl (str): create table
+        worker (int): work number, split between readers and writers
+        partitions (int, optional): how many tables to split. Defaults to 100.
+        batch_rows (int, optional): rows read per record batch. Defaults to SHUFFLE_BATCH_ROWS.
+        build_options (dict, optional): bulk, vacuum, analyze and deterministic of
+            PartitionWriter. Defaults to None.
+        callback (Callable[[dict], None], optional): called with the stats of every
+            partition as soon as it is built. Defaults to None.
+        staging (str, optional): local | direct, download the parquet files first or read them
+            from the bucket. Defaults to "local".
+
+    Raises:
+        RuntimeError: a reader or a writer failed
+
+    Returns:
+        Tuple[List[dict], List[dict]]: return the stats of every task read and of every
+            partition, see build_table_partition
+    """
+    readers = max(1, min(len(tasks), worker // 2))
+    writers = max(1, min(partitions, worker - readers))
+    batch_rows = batch_rows if batch_rows > 0 else SHUFFLE_BATCH_ROWS
+    build_options = build_options or {}
+
+    files = multiprocessing.Queue()
+    for task in tasks:
+        files.put((task["path"], task["row_groups"]))
+    for _ in range(readers):
+        files.put(None)
+    queues = [multiprocessing.Queue(maxsize=SHUFFLE_QUEUE_SIZE) for _ in range(writers)]
+    results = multiprocessing.Queue()
+    reports = multiprocessing.Queue()
+
+    writer_procs = [
+        multiprocessing.Process(
+            target=shuffle_writer,
+            args=(w, queues[w], results, readers, output_dir, schema, table_name,
+                  key_name, ddl, partitions, writers, build_options),
         )
-    pool.shutdown(wait=True)
-    return output_files
+        for w in range(writers)
+    ]
+    reader_procs = [
+        multiprocessing.Process(
+            target=shuffle_reader,
+            args=(bucket, files, queues, reports, key_name, work_dir, partitions,
+                  batch_rows, staging),
+            kwargs=kwargs,
+        )
+        for _ in range(readers)
+    ]
+    for proc in writer_procs + reader_procs:
+        proc.start()
+
+    def fail(error: str):
+        for proc in reader_procs + writer_procs:
+            proc.terminate()
+            proc.join()
+        raise RuntimeError(error)
+
+    def get(queue: multiprocessing.Queue):
+        # a killed process never reports, so the others are checked while waiting
+        while True:
+            try:
+                return queue.get(timeout=SHUFFLE_POLL_SECONDS)
+            except Empty:
+                pass
+            for name, procs in (("reader", reader_procs), ("writer", writer_procs)):
+                for proc in procs:
+                    if proc.exitcode not in (None, 0):
+                        fail(f"shuffle {name} {proc.pid} exited with code {proc.exitcode}")
+
+    # every reader reports before its writers can finish, so a failed read
+    # stops the load before any partition is handed to the callback
+    reader_stats = []
+    for _ in range(readers):
+        ret = get(reports)
+        if isinstance(ret, str):
+            fail(ret)
+        reader_stats.extend(ret)
+
+    stats = []
+    for _ in range(writers):
+        ret = get(results)
+        if isinstance(ret, str):
+            fail(ret)
+        stats.extend(ret)
+        if callback is not None:
+            for stat in ret:
+                callback(stat)
+    for proc in reader_procs + writer_procs:
+        proc.join()
+
+    stats.sort(key=lambda s: s["partition"])
+    print(f"finish shuffling table: {table_name}, partitions: {partitions}, "
+          f"rows: {sum(s['rows'] for s in stats)}")
+    return reader_stats, stats
+
+
+def stage_metrics(rows: int, nbytes: int, seconds: float) -> dict:
+    return {
+        "rows": int(rows),
+        "bytes": int(nbytes),
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds, 1) if seconds > 0 else 0.0,
+    }
+
+
+def print_metrics(stages: dict):
+    print(f"{'stage':<10}{'rows':>14}{'MiB':>12}{'seconds':>10}{'rows/s':>14}")
+    for name in LOAD_STAGES:
+        m = stages[name]
+        print(f"{name:<10}{m['rows']:>14,}{m['bytes'] / MB:>12.1f}"
+              f"{m['seconds']:>10.2f}{m['rows_per_second']:>14,.0f}")
 
 
 def to_magicdb(
@@ -421,6 +1423,25 @@ def to_magicdb(
         key_name: str,
         table_name: str,
         partitions: int = 100,
+        batch_rows: int = 0,
+        insert_mode: str = "arrow",
+        engine: str = "raw",
+        bulk_build: bool = False,
+        vacuum: bool = False,
+        analyze: bool = False,
+        layout: str = "rowid",
+        upload_workers: int = UPLOAD_WORKERS,
+        transfer: dict = None,
+        staging: str = "local",
+        retries: int = TASK_RETRIES,
+        base_version: str = "",
+        delete_column: str = "",
+        dedup: bool = False,
+        deterministic: bool = False,
+        compression: str = "",
+        compression_level: int = None,
+        target_partition_bytes: int = 0,
+        skew_factor: float = SKEW_FACTOR,
         **kwargs,
 ) -> str:
     """to magicdb data
@@ -435,77 +1456,278 @@ def to_magicdb(
         key_name (str): primary key
         table_name (str): table name
         partitions (int, optional): how many tables to split. Defaults to 100.
+        batch_rows (int, optional): rows read per record batch, 0 reads the whole file. Defaults to 0.
+        insert_mode (str, optional): arrow | pandas, how rows are fed to sqlite. Defaults to "arrow".
+        engine (str, optional): raw | shuffle, raw converts every parquet file to a raw
+            sqlite file and merges them, shuffle streams rows to the partition writers. Defaults to "raw".
+        bulk_build (bool, optional): insert the partition rows in key order. Defaults to False.
+        vacuum (bool, optional): vacuum the partition files. Defaults to False.
+        analyze (bool, optional): analyze the partition files. Defaults to False.
+        layout (str, optional): rowid | without_rowid, table layout of the partition files. Defaults to "rowid".
+        upload_workers (int, optional): partition files uploaded at the same time. Defaults to UPLOAD_WORKERS.
+        transfer (dict, optional): multipart_threshold, multipart_chunksize and max_concurrency
+            of the uploads. Defaults to None.
+        staging (str, optional): local | direct, download the parquet files first or read
+            their row groups from the bucket with ranged gets. Defaults to "local".
+        retries (int, optional): extra attempts of a failed conversion or merge task of the
+            raw engine. Defaults to TASK_RETRIES.
+        base_version (str, optional): load hive_table_dir as a delta of this version, only
+            the partitions with delta rows are rebuilt and the others are shared with
+            it, "" for a full load. Defaults to "".
+        delete_column (str, optional): integer column of the delta, rows with a non zero
+            value delete their key, "" if the delta only upserts. Defaults to "".
+        dedup (bool, optional): store the partition files under s3_data_dir/objects/ by
+            their sha256 and skip the uploads of files already there. Defaults to False.
+        deterministic (bool, optional): build every partition in key order with fixed
+            pragmas and a normalized header, so the same rows give the same file and
+            sha256 in partition_files. Defaults to False.
+        compression (str, optional): zstd | lz4, compress the partition files in the upload
+            threads, "" uploads them as they are. Defaults to "".
+        compression_level (int, optional): level of the codec, its default if None.
+            Defaults to None.
+        target_partition_bytes (int, optional): pick the partition number from the parquet
+            footers and a key sample so a partition file is about this size, 0 uses
+            partitions, delta loads keep the base partition number. Defaults to 0.
+        skew_factor (float, optional): warn about the partitions larger than this factor
+            times the mean partition size. Defaults to SKEW_FACTOR.
+
+    Raises:
+        ValueError: unknown engine or codec, a delete column without a base version, or a
+            delta not matching its base version
+        ImportError: the package of the codec is not installed
 
     Returns:
         str: version of magicdb table
     """
 
-    timestamp = int(time.time())
+    if delete_column != "" and base_version == "":
+        raise ValueError("delete_column needs a base_version, a full load has no rows to delete")
+    if compression != "":
+        check_codec(compression)
+
+    load_start = time.time()
+    timestamp = int(load_start)
     work_dir = os.path.join(work_dir, str(timestamp))
     _raw_sqlite_dir = os.path.join(work_dir, "_sqlite")
-    _bash_dir = os.path.join(work_dir, "_bash")
     table_dir = os.path.join(work_dir, "sqlite")
 
     remote_dir = os.path.join(s3_data_dir, str(timestamp))
     version = f"{table_name}.json@{timestamp}"
     local_meta_file = os.path.join(work_dir, f"{table_name}.json")
     remote_meta_file = os.path.join(s3_meta_dir, version)
+    local_metrics_file = os.path.join(work_dir, f"{table_name}.metrics.json")
+    remote_metrics_file = os.path.join(s3_meta_dir, f"{table_name}.metrics.json@{timestamp}")
 
     if os.path.exists(work_dir):
         shutil.rmtree(work_dir)
 
     os.makedirs(work_dir)
     os.makedirs(_raw_sqlite_dir)
-    os.makedirs(_bash_dir)
     os.makedirs(table_dir)
 
-    parquet_files = r_listfiles(bucket, hive_table_dir, **kwargs)
-    assert len(parquet_files) > 0
-    schema = get_table_schema(bucket=bucket,
-                              path=parquet_files[0], work_dir=work_dir, **kwargs
-                              )
+    objects = r_listfiles(bucket, hive_table_dir, **kwargs)
+    assert len(objects) > 0
+    parquet_files = [o["key"] for o in objects]
+    footers = read_parquet_footers(bucket=bucket, paths=parquet_files, **kwargs)
+    schema = get_table_schema(paths=parquet_files, footers=footers)
+    # the raw sqlite files of a delta keep its delete column, the table does not
+    raw_schema = schema
+    if delete_column != "":
+        if delete_column not in schema.names:
+            raise ValueError(f"delete column: {delete_column} not in {hive_table_dir}")
+        schema = schema.remove(schema.get_field_index(delete_column))
+
+    base = None
+    if base_version != "":
+        if engine != "raw":
+            raise ValueError(f"engine: {engine} not support for delta loads")
+        local_base_file = os.path.join(work_dir, base_version)
+        bucket_download_file(bucket=bucket, remote_path=os.path.join(s3_meta_dir, base_version),
+                             dst_path=local_base_file, **kwargs)
+        base = json.load(open(local_base_file))
+        if base["key"] != key_name or base["features"] != generate_features_from_schema(schema):
+            raise ValueError(f"delta: {hive_table_dir} does not match version: {base_version}")
+        # the partition files are shared, so their number and layout are the base ones
+        partitions = len(base["partitions"])
+        layout = base.get("layout", "rowid")
+
+    plan = None
+    if target_partition_bytes > 0 and base is None:
+        # parquet_files is sorted by size, sample the keys of the largest file
+        key_ratio = sample_key_ratio(bucket, parquet_files[0], key_name, **kwargs)
+        plan = plan_partitions(footers, target_partition_bytes, key_ratio)
+        partitions = plan["partitions"]
+        print(f"planned partitions: {partitions} for {plan['rows']:,} rows, "
+              f"about {plan['estimated_bytes'] / MB:.1f} MiB, key ratio: {plan['key_ratio']}")
+
+    # a split task reads only its row groups, which needs direct reads
+    tasks = plan_parquet_tasks(paths=parquet_files, footers=footers,
+                               sizes=[o["size"] for o in objects],
+                               split_bytes=SPLIT_BYTES if staging == "direct" else 0)
     ddl = generate_sqlite_ddl(
-        schema=schema, key_name=key_name, table_name=table_name)
-
-    raw_sqlite_files = parquets_to_raw_sqlites(
-        bucket=bucket,
-        schema=schema,
-        input_files=parquet_files,
-        output_dir=_raw_sqlite_dir,
-        key_name=key_name,
-        table_name=table_name,
-        worker=workers,
-        partitions=partitions,
-        **kwargs,
-    )
-
-    partition_files = build_table(
-        table_name=table_name,
-        ddl=ddl,
-        input_files=raw_sqlite_files,
-        output_dir=table_dir,
-        bash_dir=_bash_dir,
-        partitions=partitions,
-        worker=workers,
-    )
-
-    remote_paths = []
-    for pfile in partition_files:
-        base_name = os.path.basename(pfile)
-        remote_path = os.path.join(remote_dir, base_name)
-        remote_paths.append(remote_path)
-        bucket_upload_file(local_path=pfile, bucket=bucket, remote_path=remote_path, **kwargs)
+        schema=schema, key_name=key_name, table_name=table_name, layout=layout)
+    build_options = {"bulk": bulk_build, "vacuum": vacuum, "analyze": analyze,
+                     "deterministic": deterministic}
+
+    # every partition is uploaded, and its local file deleted, as soon as it is built
+    uploader = BucketUploader(bucket, upload_workers, transfer_config(**(transfer or {})),
+                              remove=True,
+                              content_dir=os.path.join(s3_data_dir, "objects") if dedup else None,
+                              codec=compression or None,
+                              level=compression_level,
+                              **kwargs)
+    uploads = {}
+
+    def upload_partition(stat: dict):
+        uploads[stat["partition"]] = uploader.submit(
+            stat["path"], os.path.join(remote_dir, os.path.basename(stat["path"])))
+
+    try:
+        if engine == "raw":
+            start = time.time()
+            read_stats = parquets_to_raw_sqlites(
+                bucket=bucket,
+                schema=raw_schema,
+                tasks=tasks,
+                output_dir=_raw_sqlite_dir,
+                key_name=key_name,
+                table_name=table_name,
+                worker=workers,
+                partitions=partitions,
+                batch_rows=batch_rows,
+                insert_mode=insert_mode,
+                staging=staging,
+                retries=retries,
+                **kwargs,
+            )
+            convert_seconds = time.time() - start
+
+            start = time.time()
+            partition_rows = np.sum([r["partition_rows"] for r in read_stats], axis=0).tolist()
+            if base is not None:
+                partition_stats = apply_delta(
+                    table_name=table_name,
+                    key_name=key_name,
+                    columns=schema.names,
+                    delete_column=delete_column,
+                    bucket=bucket,
+                    base_partitions=base["partitions"],
+                    input_files=[r["path"] for r in read_stats],
+                    output_dir=table_dir,
+                    partition_rows=partition_rows,
+                    worker=workers,
+                    callback=upload_partition,
+                    retries=retries,
+                    vacuum=vacuum,
+                    analyze=analyze,
+                    deterministic=deterministic,
+                    **kwargs,
+                )
+            else:
+                partition_stats = build_table(
+                    table_name=table_name,
+                    key_name=key_name,
+                    ddl=ddl,
+                    input_files=[r["path"] for r in read_stats],
+                    output_dir=table_dir,
+                    partitions=partitions,
+                    worker=workers,
+                    callback=upload_partition,
+                    partition_rows=partition_rows,
+                    retries=retries,
+                    **build_options,
+                )
+            merge_seconds = time.time() - start
+            shutil.rmtree(_raw_sqlite_dir)
+        elif engine == "shuffle":
+            # reading and merging overlap, both stages take the whole shuffle
+            start = time.time()
+            read_stats, partition_stats = shuffle_to_partitions(
+                schema=schema,
+                bucket=bucket,
+                tasks=tasks,
+                work_dir=_raw_sqlite_dir,
+                output_dir=table_dir,
+                key_name=key_name,
+                table_name=table_name,
+                ddl=ddl,
+                worker=workers,
+                partitions=partitions,
+                batch_rows=batch_rows,
+                build_options=build_options,
+                callback=upload_partition,
+                staging=staging,
+                **kwargs,
+            )
+            convert_seconds = merge_seconds = time.time() - start
+        else:
+            raise ValueError(f"engine: {engine} not support")
+    except Exception:
+        uploader.cancel()
+        raise
+    stats = uploader.wait()
+    # path, sha256 and bytes of every partition, the ones shared with the base
+    # version keep its entries
+    partition_files = [{"path": p, "sha256": None, "bytes": None}
+                       for p in (base["partitions"] if base is not None else [None] * partitions)]
+    if base is not None and "partition_files" in base:
+        partition_files = [dict(f) for f in base["partition_files"]]
+    for i, future in uploads.items():
+        ret = future.result()
+        partition_files[i] = {k: v for k, v in ret.items() if k != "skipped"}
+    remote_paths = [f["path"] for f in partition_files]
+    print(f"finish uploading table: {table_name}, files: {stats['files']}, "
+          f"skipped: {stats['skipped']}, "
+          f"{stats['bytes'] / MB / max(stats['seconds'], 1e-6):.1f} MiB/s")
+
+    rows_read = sum(s["rows"] for s in read_stats)
+    rows = sum(s["rows"] for s in partition_stats)
+    download_bytes = sum(s["download_bytes"] for s in read_stats)
+    stages = {
+        # downloads overlap the conversion, their seconds are summed over the tasks
+        "download": stage_metrics(rows_read, download_bytes,
+                                  sum(s["download_seconds"] for s in read_stats)),
+        "convert": stage_metrics(rows_read, download_bytes, convert_seconds),
+        "merge": stage_metrics(rows, sum(s["bytes"] for s in partition_stats), merge_seconds),
+        "upload": stage_metrics(rows, stats["bytes"], stats["seconds"]),
+    }
+    print_metrics(stages)
+    partition_sizes = [f["bytes"] for f in partition_files]
+    check_partition_skew(partition_sizes, skew_factor)
 
     data = {
         "name": table_name,
         "partitions": remote_paths,
+        "partition_files": partition_files,
         "key": key_name,
         "version": version,
+        "layout": layout,
         "features": generate_features_from_schema(schema=schema),
     }
+    if base is not None:
+        data["base"] = base_version
+    if plan is not None:
+        data["plan"] = plan
+    data["partition_sizes"] = partition_size_distribution([s for s in partition_sizes if s is not None])
 
     json.dump(data, open(local_meta_file, "w"))
     bucket_upload_file(local_path=local_meta_file, bucket=bucket, remote_path=remote_meta_file, **kwargs)
+
+    metrics = {
+        "name": table_name,
+        "version": version,
+        "engine": engine,
+        "staging": staging,
+        "partitions": partitions,
+        "files": len(parquet_files),
+        "tasks": len(tasks),
+        "skipped_uploads": stats["skipped"],
+        "stages": stages,
+        "seconds": round(time.time() - load_start, 3),
+    }
+    json.dump(metrics, open(local_metrics_file, "w"))
+    bucket_upload_file(local_path=local_metrics_file, bucket=bucket,
+                       remote_path=remote_metrics_file, **kwargs)
     shutil.rmtree(work_dir)
     return version
 
@@ -543,7 +1765,93 @@ def main():
         default=max(1, cpu_count() - 1),
         help="worker number to process",
     )
+    parser.add_argument(
+        "--batch_rows", type=int, default=0,
+        help="rows read per record batch, 0 reads the whole parquet file"
+    )
+    parser.add_argument(
+        "--insert_mode", type=str, default="arrow", choices=["arrow", "pandas"],
+        help="feed sqlite from arrow columns or from a pandas dataframe"
+    )
+    parser.add_argument(
+        "--engine", type=str, default="raw", choices=["raw", "shuffle"],
+        help="raw: convert then merge raw sqlite files, shuffle: stream rows to partition writers"
+    )
+    parser.add_argument(
+        "--bulk_build", action="store_true", help="insert the partition rows in key order"
+    )
+    parser.add_argument(
+        "--vacuum", action="store_true", help="vacuum the partition files"
+    )
+    parser.add_argument(
+        "--analyze", action="store_true", help="analyze the partition files"
+    )
+    parser.add_argument(
+        "--layout", type=str, default="rowid", choices=["rowid", "without_rowid"],
+        help="table layout of the partition files"
+    )
+    parser.add_argument(
+        "--staging", type=str, default="local", choices=STAGINGS,
+        help="local: download the parquet files first, direct: read them from the bucket"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=TASK_RETRIES,
+        help="extra attempts of a failed conversion or merge task"
+    )
+    parser.add_argument(
+        "--base_version", type=str, default="",
+        help="load --path as a delta of this version, example: table.json@1672502400"
+    )
+    parser.add_argument(
+        "--delete_column", type=str, default="",
+        help="integer column of the delta, rows with a non zero value delete their key"
+    )
+    parser.add_argument(
+        "--dedup", action="store_true",
+        help="store the partition files by sha256 and skip the ones already uploaded"
+    )
+    parser.add_argument(
+        "--deterministic", action="store_true",
+        help="build byte identical partition files from identical rows"
+    )
+    parser.add_argument(
+        "--compression", type=str, default="", choices=["", "zstd", "lz4"],
+        help="compress the partition files before uploading them"
+    )
+    parser.add_argument(
+        "--compression_level", type=int, default=None, help="level of the codec"
+    )
+    parser.add_argument(
+        "--target_partition_bytes", type=int, default=0,
+        help="pick the partition number so a partition file is about this size, 0 uses --partition"
+    )
+    parser.add_argument(
+        "--skew_factor", type=float, default=SKEW_FACTOR,
+        help="warn about the partitions larger than this factor times the mean partition size"
+    )
+    parser.add_argument(
+        "--upload_workers", type=int, default=UPLOAD_WORKERS,
+        help="partition files uploaded at the same time"
+    )
+    parser.add_argument(
+        "--multipart_threshold", type=int, default=MULTIPART_THRESHOLD,
+        help="files larger than this many bytes are uploaded in parts"
+    )
+    parser.add_argument(
+        "--multipart_chunksize", type=int, default=MULTIPART_CHUNKSIZE,
+        help="part size of multipart uploads in bytes"
+    )
+    parser.add_argument(
+        "--max_concurrency", type=int, default=MAX_CONCURRENCY,
+        help="parts of one file uploaded at the same time"
+    )
+    parser.add_argument(
+        "--max_pool_connections", type=int, default=MAX_POOL_CONNECTIONS,
+        help="http connections of every oss/s3 client"
+    )
     args = parser.parse_args()
+    if args.delete_column != "" and args.base_version == "":
+        parser.error("--delete_column needs --base_version")
 
     boto3_kwargs = {}
     if args.access_key != "":
@@ -554,17 +1862,39 @@ def main():
         boto3_kwargs["region_name"] = args.region
     if args.endpoint != "":
         boto3_kwargs["endpoint_url"] = args.endpoint
+    boto3_kwargs["max_pool_connections"] = args.max_pool_connections
 
     to_magicdb(
         work_dir=args.work_dir,
         workers=args.worker,
+        bucket=args.bucket,
         hive_table_dir=args.path,
         s3_data_dir=args.data,
         s3_meta_dir=args.meta,
         table_name=args.table,
         key_name=args.key,
         partitions=args.partition,
-        endpoint=args.endpoint,
+        batch_rows=args.batch_rows,
+        insert_mode=args.insert_mode,
+        engine=args.engine,
+        bulk_build=args.bulk_build,
+        vacuum=args.vacuum,
+        analyze=args.analyze,
+        layout=args.layout,
+        upload_workers=args.upload_workers,
+        transfer={"multipart_threshold": args.multipart_threshold,
+                  "multipart_chunksize": args.multipart_chunksize,
+                  "max_concurrency": args.max_concurrency},
+        staging=args.staging,
+        retries=args.retries,
+        base_version=args.base_version,
+        delete_column=args.delete_column,
+        dedup=args.dedup,
+        deterministic=args.deterministic,
+        compression=args.compression,
+        compression_level=args.compression_level,
+        target_partition_bytes=args.target_partition_bytes,
+        skew_factor=args.skew_factor,
         **boto3_kwargs,
     )
 
@@ -36,20 +36,44 @@
 #  --data_dir oss://xxx/tmp/db/data \
 #  --meta_dir oss://xxx/tmp/db/meta \
 #  --cmd "/opt/apps/HADOOP-COMMON/hadoop-common-current/bin/hadoop fs -put -f %s %s"
+#
+# or upload with boto3 (magicdb_cli installed on the executors), replacing --cmd with
+#  --bucket oss://xxx --endpoint https://oss-cn-shanghai.aliyuncs.com \
+#  --access_key xxx --secret_key xxx --region cn-shanghai
+#  and --data_dir/--meta_dir as paths inside the bucket
+#
+# or upload with the hadoop FileSystem of --data_dir/--meta_dir, replacing --cmd
+# with --hadoop, the executors write through libhdfs (pyarrow.fs.HadoopFileSystem)
+# which needs the hadoop jars and libhdfs.so in their environment:
+#  --conf spark.executorEnv.CLASSPATH="$(hadoop classpath --glob)" \
+#  --conf spark.executorEnv.ARROW_LIBHDFS_DIR=$HADOOP_HOME/lib/native \
+#  --conf spark.executorEnv.HADOOP_HOME=$HADOOP_HOME \
+#  --conf spark.executorEnv.JAVA_HOME=$JAVA_HOME
 
 
+import abc
 import argparse
+import hashlib
 import json
+import math
 import os
 import random
 import shutil
 import sqlite3
+import struct
+import subprocess
 import time
+import urllib.parse
 from enum import IntEnum
 from typing import Callable, Tuple
 
-from pyspark import RDD
+import numpy as np
+import pandas as pd
+import pyarrow
+import pyarrow.compute as pc
+from pyspark import SparkContext
 from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql.functions import col, pandas_udf
 from pyspark.sql.types import (
     BinaryType,
     ByteType,
@@ -63,6 +87,11 @@ from pyspark.sql.types import (
     StringType,
 )
 
+try:
+    import mmh3
+except ImportError:
+    mmh3 = None
+
 
 class FeatureDataType(IntEnum):
     StringListType = 1
@@ -115,6 +144,9 @@ def fmix(k):
 
 
 def hash64(key, seed=0, signed=True):
+    """murmur3 x64 128 of the utf-8 bytes of key, the same as mmh3.hash64"""
+    if isinstance(key, str):
+        key = key.encode("utf-8")
     length = len(key)
     nblocks = int(length / 16)
     h1 = seed
@@ -126,25 +158,25 @@ def hash64(key, seed=0, signed=True):
     for block_start in range(0, nblocks * 8, 8):
         # ??? big endian?
         k1 = (
-            ord(key[2 * block_start + 7]) << 56
-            | ord(key[2 * block_start + 6]) << 48
-            | ord(key[2 * block_start + 5]) << 40
-            | ord(key[2 * block_start + 4]) << 32
-            | ord(key[2 * block_start + 3]) << 24
-            | ord(key[2 * block_start + 2]) << 16
-            | ord(key[2 * block_start + 1]) << 8
-            | ord(key[2 * block_start + 0])
+            key[2 * block_start + 7] << 56
+            | key[2 * block_start + 6] << 48
+            | key[2 * block_start + 5] << 40
+            | key[2 * block_start + 4] << 32
+            | key[2 * block_start + 3] << 24
+            | key[2 * block_start + 2] << 16
+            | key[2 * block_start + 1] << 8
+            | key[2 * block_start + 0]
         )
 
         k2 = (
-            ord(key[2 * block_start + 15]) << 56
-            | ord(key[2 * block_start + 14]) << 48
-            | ord(key[2 * block_start + 13]) << 40
-            | ord(key[2 * block_start + 12]) << 32
-            | ord(key[2 * block_start + 11]) << 24
-            | ord(key[2 * block_start + 10]) << 16
-            | ord(key[2 * block_start + 9]) << 8
-            | ord(key[2 * block_start + 8])
+            key[2 * block_start + 15] << 56
+            | key[2 * block_start + 14] << 48
+            | key[2 * block_start + 13] << 40
+            | key[2 * block_start + 12] << 32
+            | key[2 * block_start + 11] << 24
+            | key[2 * block_start + 10] << 16
+            | key[2 * block_start + 9] << 8
+            | key[2 * block_start + 8]
         )
         k1 = (c1 * k1) & 0xFFFFFFFFFFFFFFFF
         k1 = (k1 << 31 | k1 >> 33) & 0xFFFFFFFFFFFFFFFF  # inlined ROTL64
@@ -170,19 +202,19 @@ def hash64(key, seed=0, signed=True):
     tail_size = length & 15
 
     if tail_size >= 15:
-        k2 ^= ord(key[tail_index + 14]) << 48
+        k2 ^= key[tail_index + 14] << 48
     if tail_size >= 14:
-        k2 ^= ord(key[tail_index + 13]) << 40
+        k2 ^= key[tail_index + 13] << 40
     if tail_size >= 13:
-        k2 ^= ord(key[tail_index + 12]) << 32
+        k2 ^= key[tail_index + 12] << 32
     if tail_size >= 12:
-        k2 ^= ord(key[tail_index + 11]) << 24
+        k2 ^= key[tail_index + 11] << 24
     if tail_size >= 11:
-        k2 ^= ord(key[tail_index + 10]) << 16
+        k2 ^= key[tail_index + 10] << 16
     if tail_size >= 10:
-        k2 ^= ord(key[tail_index + 9]) << 8
+        k2 ^= key[tail_index + 9] << 8
     if tail_size >= 9:
-        k2 ^= ord(key[tail_index + 8])
+        k2 ^= key[tail_index + 8]
 
     if tail_size > 8:
         k2 = (k2 * c2) & 0xFFFFFFFFFFFFFFFF
@@ -191,21 +223,21 @@ def hash64(key, seed=0, signed=True):
         h2 ^= k2
 
     if tail_size >= 8:
-        k1 ^= ord(key[tail_index + 7]) << 56
+        k1 ^= key[tail_index + 7] << 56
     if tail_size >= 7:
-        k1 ^= ord(key[tail_index + 6]) << 48
+        k1 ^= key[tail_index + 6] << 48
     if tail_size >= 6:
-        k1 ^= ord(key[tail_index + 5]) << 40
+        k1 ^= key[tail_index + 5] << 40
     if tail_size >= 5:
-        k1 ^= ord(key[tail_index + 4]) << 32
+        k1 ^= key[tail_index + 4] << 32
     if tail_size >= 4:
-        k1 ^= ord(key[tail_index + 3]) << 24
+        k1 ^= key[tail_index + 3] << 24
     if tail_size >= 3:
-        k1 ^= ord(key[tail_index + 2]) << 16
+        k1 ^= key[tail_index + 2] << 16
     if tail_size >= 2:
-        k1 ^= ord(key[tail_index + 1]) << 8
+        k1 ^= key[tail_index + 1] << 8
     if tail_size >= 1:
-        k1 ^= ord(key[tail_index + 0])
+        k1 ^= key[tail_index + 0]
 
     if tail_size > 0:
         k1 = (k1 * c1) & 0xFFFFFFFFFFFFFFFF
@@ -231,8 +263,99 @@ def hash64(key, seed=0, signed=True):
     return h1, h2
 
 
-def repartition(df: DataFrame, key: str, partition: int) -> RDD:
-    """use mmh to repartition
+# settings of every partition file, page_size must be set before the first table
+PARTITION_PRAGMAS = [
+    "PRAGMA page_size = 16384;",
+    "PRAGMA cache_size = -65536;",
+    "PRAGMA locking_mode = EXCLUSIVE;",
+    "PRAGMA synchronous = OFF;",
+    "PRAGMA journal_mode = OFF;",
+]
+
+
+# upper bound of a planned partition number
+MAX_PARTITIONS = 4096
+
+# partitions larger than this factor times the mean partition size are reported as skewed
+SKEW_FACTOR = 2.0
+
+# rows sampled to estimate the bytes per row and the key cardinality
+PLAN_SAMPLE_ROWS = 100000
+
+# column holding the partition id of every row while repartitioning
+PID_COLUMN = "_magicdb_pid"
+
+# rows returned by the partition writers
+PARTITION_FILE_SCHEMA = "partition long, path string, sha256 string, bytes long, rows long, seconds double"
+PARTITION_FILE_FIELDS = [
+    ("partition", pyarrow.int64()),
+    ("path", pyarrow.string()),
+    ("sha256", pyarrow.string()),
+    ("bytes", pyarrow.int64()),
+    ("rows", pyarrow.int64()),
+    ("seconds", pyarrow.float64()),
+]
+
+
+def normalize_sqlite_header(path: str):
+    """reset the file change counter and the version-valid-for number of a
+    closed sqlite file, both to 1 so the in-header database size stays valid"""
+    with open(path, "r+b") as f:
+        f.seek(24)
+        f.write(struct.pack(">I", 1))
+        f.seek(92)
+        f.write(struct.pack(">I", 1))
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def key_hash(key) -> int:
+    """murmur3 hash of a key like magicdbLoad, mmh3.hash64(str(key), signed=False)[0],
+    with the mmh3 c extension when it is installed
+
+    Args:
+        key: string or integer key
+
+    Returns:
+        int: unsigned 64 bits hash
+    """
+    if mmh3 is not None:
+        return mmh3.hash64(str(key), signed=False)[0]
+    return hash64(str(key), seed=0, signed=False)[0]
+
+
+def hash_partition_ids(keys: pd.Series, partition: int) -> pd.Series:
+    """partition ids of a key column, batched with magicdb_cli.hash_util when it
+    is installed on the executors, else key by key
+
+    Args:
+        keys (pd.Series): string or integer keys
+        partition (int): partition number
+
+    Returns:
+        pd.Series: key_hash(key) % partition of every key, int64
+    """
+    try:
+        from magicdb_cli.hash_util import partition_ids
+    except ImportError:
+        return pd.Series(np.fromiter((key_hash(k) % partition for k in keys),
+                                     dtype=np.int64, count=len(keys)), index=keys.index)
+    return pd.Series(partition_ids(pyarrow.array(keys), partition), index=keys.index)
+
+
+def repartition(df: DataFrame, key: str, partition: int) -> DataFrame:
+    """use mmh to repartition, the partition id is computed as a column and the
+    rows are range partitioned on it by spark, so a spark partition holds one
+    partition id, and it is sorted by key
+
+    The range bounds come from a sample of the partition ids, the writer still
+    handles a spark partition holding several of them.
 
     Args:
         df (DataFrame): parquet dataframe
@@ -240,14 +363,104 @@ def repartition(df: DataFrame, key: str, partition: int) -> RDD:
         partition (int): partition number
 
     Returns:
-        RDD: repartitioned rdd
+        DataFrame: repartitioned dataframe with the PID_COLUMN column
     """
-    return df.rdd.map(lambda x: (x[key], x)).partitionBy(
-        numPartitions=partition,
-        partitionFunc=lambda _: hash64(_, seed=0, signed=False)[0],
+
+    def pid(keys: pd.Series) -> pd.Series:
+        return hash_partition_ids(keys, partition)
+
+    return (
+        df.withColumn(PID_COLUMN, pandas_udf(pid, LongType())(col(key)))
+        .repartitionByRange(partition, col(PID_COLUMN))
+        .sortWithinPartitions(PID_COLUMN, key)
+    )
+
+
+def partition_file_batch(pfile: dict) -> pyarrow.RecordBatch:
+    """one row arrow batch of the stats of a partition file, see PARTITION_FILE_SCHEMA"""
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array([pfile[name]], type=dtype) for name, dtype in PARTITION_FILE_FIELDS],
+        names=[name for name, _ in PARTITION_FILE_FIELDS],
     )
 
 
+def arrow_rows(batch: pyarrow.RecordBatch, names: list) -> list:
+    """python rows of some columns of an arrow batch, decimals as floats
+
+    Args:
+        batch (pyarrow.RecordBatch): arrow batch
+        names (list): column names
+
+    Returns:
+        list: row tuples
+    """
+    columns = []
+    for name in names:
+        column = batch.column(batch.schema.get_field_index(name))
+        if pyarrow.types.is_decimal(column.type):
+            column = pc.cast(column, pyarrow.float64())
+        columns.append(column.to_pylist())
+    return list(zip(*columns))
+
+
+def plan_partitions(df: DataFrame, key: str, target_bytes: int,
+                    max_partitions: int = MAX_PARTITIONS) -> dict:
+    """pick the partition number, the rows come from the parquet metadata and a sample
+    gives the arrow bytes per row and the ratio of distinct keys
+
+    Args:
+        df (DataFrame): parquet dataframe
+        key (str): primary key
+        target_bytes (int): partition file size aimed at
+        max_partitions (int, optional): upper bound of the partition number. Defaults to MAX_PARTITIONS.
+
+    Returns:
+        dict: partitions, rows, key_ratio, estimated_bytes and target_bytes
+    """
+    rows = df.count()
+    sample = df.limit(PLAN_SAMPLE_ROWS).toPandas()
+    key_ratio, row_bytes = 1.0, 0.0
+    if len(sample) > 0:
+        key_ratio = sample[key].nunique() / len(sample)
+        row_bytes = pyarrow.Table.from_pandas(sample, preserve_index=False).nbytes / len(sample)
+    estimated_bytes = int(rows * key_ratio * row_bytes)
+    partitions = min(max(math.ceil(estimated_bytes / target_bytes), 1), max_partitions)
+    return {"partitions": partitions, "rows": rows, "key_ratio": round(key_ratio, 4),
+            "estimated_bytes": estimated_bytes, "target_bytes": target_bytes}
+
+
+def partition_size_distribution(sizes: list) -> dict:
+    """min, mean, p50, p95 and max bytes of the partition files"""
+    if len(sizes) == 0:
+        return {}
+    sizes = np.asarray(sizes, dtype=np.int64)
+    return {"min": int(sizes.min()), "mean": int(sizes.mean()),
+            "p50": int(np.percentile(sizes, 50)), "p95": int(np.percentile(sizes, 95)),
+            "max": int(sizes.max())}
+
+
+def check_partition_skew(sizes: list, skew_factor: float = SKEW_FACTOR) -> list:
+    """warn about the partitions larger than skew_factor times the mean size
+
+    Args:
+        sizes (list): bytes of every partition file
+        skew_factor (float, optional): allowed size over the mean size. Defaults to SKEW_FACTOR.
+
+    Returns:
+        list: skewed partition ids
+    """
+    if len(sizes) == 0:
+        return []
+    mean = float(np.mean(sizes))
+    skewed = [i for i, s in enumerate(sizes) if s > skew_factor * mean]
+    if len(skewed) > 0:
+        print(f"warning: {len(skewed)} partitions over {skew_factor} times the mean size "
+              f"{mean / 1024 / 1024:.1f} MiB, the largest: "
+              + ", ".join(f"{i} ({sizes[i] / 1024 / 1024:.1f} MiB)"
+                          for i in sorted(skewed, key=lambda i: -sizes[i])[:10]))
+    return skewed
+
+
 def type_transform(dtype: DataType) -> Tuple[FeatureStoreType, FeatureDataType]:
     """type of feature
 
@@ -269,6 +482,104 @@ def type_transform(dtype: DataType) -> Tuple[FeatureStoreType, FeatureDataType]:
     raise TypeError(f"{dtype} not supported")
 
 
+class Uploader(abc.ABC):
+    """upload a local file to a remote path, a failed upload raises so the spark
+    task fails and is retried, instances are pickled to the executors"""
+
+    @abc.abstractmethod
+    def upload(self, local_path: str, remote_path: str):
+        pass
+
+    def __call__(self, local_path: str, remote_path: str):
+        self.upload(local_path, remote_path)
+
+
+class CommandUploader(Uploader):
+    """upload with a shell command, example: hadoop fs -put -f %s %s"""
+
+    def __init__(self, cmd: str) -> None:
+        """
+        Args:
+            cmd (str): command format, formatted with the local and the remote path
+        """
+        self.cmd = cmd
+
+    def upload(self, local_path: str, remote_path: str):
+        cmd = self.cmd % (local_path, remote_path)
+        ret = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if ret.returncode != 0:
+            raise RuntimeError(f"upload command: {cmd} exit with {ret.returncode}: "
+                               f"{ret.stdout.decode(errors='replace')}")
+
+
+class Boto3Uploader(Uploader):
+    """upload to s3/oss with the cached boto3 client of magicdb_cli, multipart and
+    retried, magicdb_cli must be installed on the executors"""
+
+    def __init__(self, bucket: str, multipart_threshold: int, multipart_chunksize: int,
+                 max_concurrency: int, retries: int = 2, **kwargs) -> None:
+        """
+        Args:
+            bucket (str): bucket name example: oss://bucket1 | s3://bucket1
+            multipart_threshold (int): files larger than this many bytes are uploaded in parts
+            multipart_chunksize (int): part size of multipart uploads in bytes
+            max_concurrency (int): parts of one file uploaded at the same time
+            retries (int, optional): extra attempts of a failed file, the last failure
+                fails the spark task. Defaults to 2.
+        """
+        self.bucket = bucket
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.kwargs = kwargs
+
+    def upload(self, local_path: str, remote_path: str):
+        from magicdb_cli.bucket_util import bucket_upload_file, transfer_config
+
+        transfer = transfer_config(multipart_threshold=self.multipart_threshold,
+                                   multipart_chunksize=self.multipart_chunksize,
+                                   max_concurrency=self.max_concurrency)
+        bucket_upload_file(local_path, self.bucket, remote_path, transfer,
+                           retries=self.retries, **self.kwargs)
+
+
+class HadoopUploader(Uploader):
+    """upload with the hadoop FileSystem of the remote path, through the jvm
+    gateway on the driver and through libhdfs (pyarrow.fs.HadoopFileSystem) on
+    the executors, which have no jvm gateway"""
+
+    def __init__(self) -> None:
+        self._filesystems = {}
+
+    def __getstate__(self):
+        return {"_filesystems": {}}
+
+    def _upload_jvm(self, sc: SparkContext, local_path: str, remote_path: str):
+        fs_path = sc._jvm.org.apache.hadoop.fs.Path
+        dst = fs_path(remote_path)
+        fs = dst.getFileSystem(sc._jsc.hadoopConfiguration())
+        fs.copyFromLocalFile(False, True, fs_path("file://" + os.path.abspath(local_path)), dst)
+
+    def _upload_libhdfs(self, local_path: str, remote_path: str):
+        from pyarrow import fs as pafs
+
+        url = urllib.parse.urlparse(remote_path)
+        host = f"{url.scheme}://{url.netloc}" if url.scheme != "" else "default"
+        if host not in self._filesystems:
+            self._filesystems[host] = pafs.HadoopFileSystem(host, 0)
+        with open(local_path, "rb") as src, \
+                self._filesystems[host].open_output_stream(url.path) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def upload(self, local_path: str, remote_path: str):
+        sc = SparkContext._active_spark_context
+        if sc is not None:
+            self._upload_jvm(sc, local_path, remote_path)
+        else:
+            self._upload_libhdfs(local_path, remote_path)
+
+
 def to_magicdb(
     df: DataFrame,
     key: str,
@@ -277,6 +588,9 @@ def to_magicdb(
     upload_func: Callable[[str, str], None],
     data_dir: str,
     meta_dir: str,
+    deterministic: bool = False,
+    target_partition_bytes: int = 0,
+    skew_factor: float = SKEW_FACTOR,
 ) -> None:
     """parquet to magicdb
 
@@ -285,9 +599,16 @@ def to_magicdb(
         key (str): primary key
         partition (int): partition number
         table (str): table name
-        upload_func (Callable[[str, str], None]): upload function
+        upload_func (Callable[[str, str], None]): upload function, usually an Uploader,
+            it must raise when an upload fails
         data_dir (str): magicdb data directory
         meta_dir (str): magicdb meta directory
+        deterministic (bool, optional): compact the file with VACUUM INTO and normalize
+            its header, so the same rows give the same file. Defaults to False.
+        target_partition_bytes (int, optional): pick the partition number so a partition
+            file is about this size, 0 uses partition. Defaults to 0.
+        skew_factor (float, optional): warn about the partitions larger than this factor
+            times the mean partition size. Defaults to SKEW_FACTOR.
     """
     schema = df.schema
     items, features = [], []
@@ -312,9 +633,18 @@ def to_magicdb(
     )
 
     print(ddl, dml)
-    rdd = repartition(df, key, partition)
-
-    def func(splitIndex, iterator):
+    plan = None
+    if target_partition_bytes > 0:
+        plan = plan_partitions(df, key, target_partition_bytes)
+        partition = plan["partitions"]
+        print(f"planned partitions: {partition} for {plan['rows']:,} rows, "
+              f"about {plan['estimated_bytes'] / 1024 / 1024:.1f} MiB, key ratio: {plan['key_ratio']}")
+
+    sc = SparkSession.builder.getOrCreate().sparkContext
+    rows_accumulator = sc.accumulator(0)
+    seconds_accumulator = sc.accumulator(0.0)
+
+    def make_output_dir() -> str:
         output_dir = "/tmp/%s-%s" % (
             int(time.time()),
             "{:0>5d}".format(random.randint(0, 99999)),
@@ -322,38 +652,117 @@ def to_magicdb(
         if os.path.exists(output_dir):
             shutil.rmtree(output_dir)
         os.makedirs(output_dir)
-        index_str = "{:0>5d}".format(splitIndex)
-        local_path = os.path.join(output_dir, f"{index_str}.db")
-        remote_path = os.path.join(data_dir, f"{index_str}.db")
-        conn = sqlite3.connect(local_path)
+        return output_dir
+
+    def open_partition(output_dir, index):
+        local_path = os.path.join(output_dir, "{:0>5d}.db".format(index))
+        # autocommit mode, the rows go in one explicit transaction
+        conn = sqlite3.connect(local_path, isolation_level=None)
         cur = conn.cursor()
+        for pragma in PARTITION_PRAGMAS:
+            cur.execute(pragma)
         cur.execute(ddl)
-        conn.commit()
-        cur.execute("""PRAGMA synchronous = OFF;""")
-        cur.execute("""PRAGMA journal_mode = OFF;""")
-        rows = []
-        for r in iterator:
-            rows.append(r[1])
-            if len(rows) > 1000:
-                cur.executemany(dml, rows)
-                rows = []
-        if len(rows) > 0:
-            cur.executemany(dml, rows)
-        conn.commit()
+        cur.execute("BEGIN;")
+        return {"index": index, "path": local_path, "conn": conn, "cur": cur,
+                "rows": 0, "start": time.time()}
+
+    def close_partition(part) -> dict:
+        local_path, conn, cur = part["path"], part["conn"], part["cur"]
+        cur.execute("COMMIT;")
+        if deterministic:
+            cur.execute("VACUUM INTO ?;", (f"{local_path}.compact",))
         cur.close()
         conn.close()
+        if deterministic:
+            os.replace(f"{local_path}.compact", local_path)
+            normalize_sqlite_header(local_path)
+        remote_path = os.path.join(data_dir, "{:0>5d}.db".format(part["index"]))
+        pfile = {"partition": part["index"], "path": remote_path, "sha256": file_sha256(local_path),
+                 "bytes": os.path.getsize(local_path), "rows": part["rows"],
+                 "seconds": time.time() - part["start"]}
         upload_func(local_path, remote_path)
+        os.remove(local_path)
+        rows_accumulator.add(pfile["rows"])
+        seconds_accumulator.add(pfile["seconds"])
+        return pfile
+
+    def func(batches):
+        # arrow batches sorted by partition id and key, so every file is written in key order
+        output_dir = make_output_dir()
+        part = None
+        for batch in batches:
+            pids = batch.column(batch.schema.get_field_index(PID_COLUMN)).to_numpy()
+            starts = np.concatenate([[0], np.flatnonzero(np.diff(pids)) + 1])
+            ends = np.append(starts[1:], batch.num_rows)
+            for start, end in zip(starts, ends):
+                index = int(pids[start])
+                if part is None or part["index"] != index:
+                    if part is not None:
+                        yield partition_file_batch(close_partition(part))
+                    part = open_partition(output_dir, index)
+                part["cur"].executemany(dml, arrow_rows(batch.slice(start, end - start), schema.names))
+                part["rows"] += int(end - start)
+        if part is not None:
+            yield partition_file_batch(close_partition(part))
+        shutil.rmtree(output_dir)
+
+    def func_pandas(batches):
+        # spark before 3.3 has no mapInArrow
+        for batch in func(pyarrow.RecordBatch.from_pandas(b, preserve_index=False) for b in batches):
+            yield batch.to_pandas()
+
+    start = time.time()
+    repartitioned = repartition(df, key, partition)
+    if hasattr(repartitioned, "mapInArrow"):
+        repartitioned = repartitioned.mapInArrow(func, PARTITION_FILE_SCHEMA)
+    else:
+        repartitioned = repartitioned.mapInPandas(func_pandas, PARTITION_FILE_SCHEMA)
+    written = {r["partition"]: r.asDict() for r in repartitioned.collect()}
+    # partition ids without any row, as in tables with fewer keys than
+    # partitions, get an empty file
+    missing = [i for i in range(partition) if i not in written]
+    if len(missing) > 0:
+        output_dir = make_output_dir()
+        for index in missing:
+            written[index] = close_partition(open_partition(output_dir, index))
         shutil.rmtree(output_dir)
-        return [remote_path]
+    seconds = time.time() - start
+
+    stats = [written[i] for i in range(partition)]
+    slowest = max(stats, key=lambda x: x["seconds"])
+    print(f"rows: {rows_accumulator.value:,}, build seconds: {seconds_accumulator.value:.2f} "
+          f"over {partition} partitions, {seconds:.2f}s wall, slowest partition: "
+          f"{slowest['partition']} with {slowest['rows']:,} rows in {slowest['seconds']:.2f}s")
+
+    check_partition_skew([f["bytes"] for f in stats], skew_factor)
 
-    files = rdd.mapPartitionsWithIndex(func).collect()
+    version = int(time.time())
+    files = [{"path": f["path"], "sha256": f["sha256"], "bytes": f["bytes"]} for f in stats]
     data = {
         "name": table,
-        "version": int(time.time()),
-        "partitions": files,
+        "version": version,
+        "partitions": [f["path"] for f in files],
+        "partition_files": files,
         "features": features,
         "key": key,
+        "partition_sizes": partition_size_distribution([f["bytes"] for f in files]),
     }
+    if plan is not None:
+        data["plan"] = plan
+    metrics = {
+        "name": table,
+        "version": version,
+        "rows": rows_accumulator.value,
+        "seconds": seconds,
+        "partitions": [{k: f[k] for k in ("partition", "rows", "bytes", "seconds")} for f in stats],
+    }
+    local_metrics = "/tmp/%s-%s-%s.metrics.json" % (
+        int(time.time()),
+        "{:0>5d}".format(random.randint(0, 99999)),
+        table,
+    )
+    json.dump(metrics, open(local_metrics, "w"))
+    upload_func(local_metrics, os.path.join(meta_dir, f"{table}.metrics.json@{version}"))
     local_meta = "/tmp/%s-%s-%s.json" % (
         int(time.time()),
         "{:0>5d}".format(random.randint(0, 99999)),
@@ -372,12 +781,55 @@ def main():
     parser.add_argument("--partition", type=int, default=100, help="partition number")
     parser.add_argument("--data_dir", type=str, required=True, help="data dir")
     parser.add_argument("--meta_dir", type=str, required=True, help="meta dir")
-    parser.add_argument("--cmd", type=str, required=True, help="upload command format")
-
-    def upload_func(local, remote):
-        os.system(f"{args.cmd % (local, remote)}")
+    parser.add_argument("--cmd", type=str, default="", help="upload command format")
+    parser.add_argument("--hadoop", action="store_true",
+                        help="upload with the hadoop FileSystem of --data_dir/--meta_dir instead of --cmd")
+    parser.add_argument("--bucket", type=str, default="",
+                        help="upload with boto3 to this bucket instead of --cmd, example: s3://bucket-name")
+    parser.add_argument("--access_key", type=str, default="", help="access key")
+    parser.add_argument("--secret_key", type=str, default="", help="secret key")
+    parser.add_argument("--region", type=str, default="", help="region")
+    parser.add_argument("--endpoint", type=str, default="", help="endpoint")
+    parser.add_argument("--multipart_threshold", type=int, default=64 * 1024 * 1024,
+                        help="files larger than this many bytes are uploaded in parts")
+    parser.add_argument("--multipart_chunksize", type=int, default=16 * 1024 * 1024,
+                        help="part size of multipart uploads in bytes")
+    parser.add_argument("--max_concurrency", type=int, default=8,
+                        help="parts of one file uploaded at the same time")
+    parser.add_argument("--target_partition_bytes", type=int, default=0,
+                        help="pick the partition number so a partition file is about this size, "
+                             "0 uses --partition")
+    parser.add_argument("--skew_factor", type=float, default=SKEW_FACTOR,
+                        help="warn about the partitions larger than this factor times the mean partition size")
+    parser.add_argument("--deterministic", action="store_true",
+                        help="build byte identical partition files from identical rows")
+
+    parser.add_argument("--upload_retries", type=int, default=2,
+                        help="extra attempts of a failed upload with --bucket, 0 tries once")
 
     args = parser.parse_args()
+    if [args.cmd != "", args.bucket != "", args.hadoop].count(True) != 1:
+        parser.error("exactly one of --cmd, --bucket and --hadoop is required")
+    if args.upload_retries < 0:
+        parser.error("--upload_retries must not be negative")
+
+    if args.bucket != "":
+        boto3_kwargs = {}
+        if args.access_key != "":
+            boto3_kwargs["aws_access_key_id"] = args.access_key
+        if args.secret_key != "":
+            boto3_kwargs["aws_secret_access_key"] = args.secret_key
+        if args.region != "":
+            boto3_kwargs["region_name"] = args.region
+        if args.endpoint != "":
+            boto3_kwargs["endpoint_url"] = args.endpoint
+        uploader = Boto3Uploader(args.bucket, args.multipart_threshold, args.multipart_chunksize,
+                                 args.max_concurrency, args.upload_retries, **boto3_kwargs)
+    elif args.hadoop:
+        uploader = HadoopUploader()
+    else:
+        uploader = CommandUploader(args.cmd)
+
     spark = (
         SparkSession.builder.master("yarn")
         .appName(f"magicdb-cli-{args.table}")
@@ -391,9 +843,12 @@ def main():
         key=args.key,
         partition=args.partition,
         table=args.table,
-        upload_func=upload_func,
+        upload_func=uploader,
         data_dir=args.data_dir,
         meta_dir=args.meta_dir,
+        deterministic=args.deterministic,
+        target_partition_bytes=args.target_partition_bytes,
+        skew_factor=args.skew_factor,
     )
 
 
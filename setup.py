@@ -56,6 +56,10 @@ setup(
     include_package_data=True,
     platforms="any",
     install_requires=get_requires(path.join(here, "requirements.txt")),
+    extras_require={
+        "zstd": ["zstandard"],
+        "lz4": ["lz4"],
+    },
     scripts=[],
     entry_points={
         'console_scripts': [